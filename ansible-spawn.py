@@ -1,21 +1,27 @@
 #!/usr/bin/env python
 
 import sys
+import tempfile
 import time
 import uuid
+import os
 import os.path
 
 import util
 import nssh
 import fastnovaboot
+import sshprobe
 import argparse
 
 i = util.logger.info
-interval = 3
 
 desc = ('Spawn a VM and run an Ansible playbook on it. The playbook comes '
         'in -p argument. the rest of the arguments are passed to '
-        'fastnovaboot.')
+        'fastnovaboot. With -c N, N VMs are spawned concurrently and the '
+        'playbook runs once over all of them.')
+
+# name of inventory group of VMs spawned in fleet mode (-c)
+FLEET_GROUP = 'fleet'
 
 def ask():
     l = util.NovaProxy().images.list()
@@ -36,6 +42,7 @@ def ask():
 
 def main(args_list):
     args, unparsed_args_list = get_args(args_list)
+    util.setup_profile(args)
 
     if not os.path.isfile(args.playbook):
         raise util.AnsibleWrapperError("Given playbook doesn't exist")
@@ -60,6 +67,9 @@ def main(args_list):
         # this will cause nova boot to do only a test run
         unparsed_args_list += ['-t']
 
+    if args.count > 1:
+        return spawn_fleet(args, unparsed_args_list)
+
     i("About to run fastnovaboot with args: %s" % unparsed_args_list)
     image_id, ip = fastnovaboot.main(unparsed_args_list)
 
@@ -68,11 +78,8 @@ def main(args_list):
     user = nssh.get_ssh_user(image_id)
 
     if not args.test:
-        i("About to spin-wait for when ssh is up on the new instance")
-        while nssh.test_ssh_connection(user, ip) != 0:
-            i("The VM on IP %s is not ready yet. Sleeping for %d seconds" %
-              (ip, interval))
-            time.sleep(interval)
+        i("About to wait for when ssh is up on the new instance")
+        sshprobe.wait_for_ssh({ip: user})
     else:
         i('A test run, _NOT_ spawning the VM')
 
@@ -86,6 +93,70 @@ def main(args_list):
         i('A test run, _NOT_ running ansible-playbook')
 
 
+def write_inventory(hosts):
+    """Writes temporary Ansible inventory with FLEET_GROUP of hosts.
+
+    hosts is dict ip -> ssh user. Returns path of the inventory file.
+    """
+    fd, path = tempfile.mkstemp(prefix='ansible-spawn-', suffix='.ini')
+    with os.fdopen(fd, 'w') as f:
+        f.write("[%s]\n" % FLEET_GROUP)
+        for ip, user in sorted(hosts.items()):
+            line = "%s ansible_ssh_user=%s" % (ip, user)
+            if user != 'root':
+                line += " ansible_sudo=true"
+            f.write(line + "\n")
+    return path
+
+
+def spawn_fleet(args, fastnovaboot_args):
+    """Boots args.count VMs concurrently, waits for sshd on all of them and
+    runs the playbook once over all of them."""
+    timings = []
+    start = time.time()
+
+    fastnovaboot_args = fastnovaboot_args + ['--count', str(args.count)]
+    i("About to run fastnovaboot with args: %s" % fastnovaboot_args)
+    with util.phase('boot'):
+        image_id, rows = fastnovaboot.main(fastnovaboot_args)
+    timings.append(('boot', time.time() - start))
+
+    if args.test:
+        i('A test run, _NOT_ spawning the VMs and _NOT_ running '
+          'ansible-playbook')
+        return
+
+    ips = [r['floating_ip'] for r in rows if r['floating_ip']]
+    if len(ips) < args.count:
+        util.logger.error("Only %d of %d VMs got a floating IP, running the "
+                          "playbook on those" % (len(ips), args.count))
+    if not ips:
+        raise util.AnsibleWrapperError("No VM of the fleet is up")
+    user = nssh.get_ssh_user(image_id)
+    hosts = dict((ip, user) for ip in ips)
+
+    phase_start = time.time()
+    i("About to wait for ssh on %d VMs" % len(hosts))
+    with util.phase('ssh wait'):
+        sshprobe.wait_for_ssh(hosts)
+    timings.append(('ssh wait', time.time() - phase_start))
+
+    inventory = write_inventory(hosts)
+    try:
+        ansible_cmd = ("ansible-playbook %s -i %s -f %d -e h=%s" %
+                       (args.playbook, inventory, len(hosts), FLEET_GROUP))
+        i("VMs ready. About to execute %s" % ansible_cmd)
+        phase_start = time.time()
+        util.callCheck(ansible_cmd)
+        timings.append(('playbook', time.time() - phase_start))
+    finally:
+        os.unlink(inventory)
+
+    timings.append(('total', time.time() - start))
+    i("Fleet of %d VMs done:\n%s" % (len(hosts), "\n".join(
+        "%-10s %7.1fs" % t for t in timings)))
+
+
 def get_args(args_list):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -95,10 +166,15 @@ def get_args(args_list):
     help_playbook = 'ansible playbook with - hosts: "{{ h }}"'
     help_test = 'test - dont spawn and dont run ansible'
     help_image = 'image from which to make the instance'
+    help_count = ('number of VMs to spawn. They are booted concurrently and '
+                  'the playbook runs once for all of them.')
 
     parser.add_argument('-p', '--playbook', help=help_playbook, required=True)
     parser.add_argument('-t', '--test', help=help_test, action='store_true')
     parser.add_argument('-i', '--image', help=help_image, required=False)
+    parser.add_argument('-c', '--count', help=help_count, type=int,
+                        default=1)
+    util.add_profile_args(parser)
 
     # returns tupe (args with populated namespace, remaining unparsed opts)
     return parser.parse_known_args(args_list)
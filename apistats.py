@@ -0,0 +1,212 @@
+"""
+Recording of OpenStack API calls, for the --profile option of the tools.
+
+When enabled, requests.Session.send (used by the Nova, Keystone and newer
+Glance and Neutron clients) and httplib2.Http.request (used by older
+neutronclient) are wrapped, and each HTTP call is recorded with its service,
+method, URL template, status, latency and response size. The URL template is
+the path after the service endpoint, with ids replaced by {id} and with the
+names (not values) of query parameters, so that i.e. all servers.get calls
+add up in one line of the report.
+
+Tools can mark phases of their work (see phase()); a call belongs to the
+innermost phase open when it completes, whichever thread made it. At exit, a
+report is printed to stderr and/or calls and phases are appended to a file
+as JSON lines.
+
+This module doesn't import anything heavy until enabled.
+"""
+
+import atexit
+import collections
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urlparse
+
+Call = collections.namedtuple('Call', ['service', 'method', 'template',
+                                       'status', 'latency', 'size', 'phase',
+                                       'start'])
+
+# path segments which are ids: uuids, hex strings and numbers, optionally
+# with a format suffix which is kept in the template
+ID_SEGMENT = re.compile(
+    r'^([0-9a-fA-F-]{32,36}|[0-9a-fA-F]{32}|\d+)(\.json|\.xml|)$')
+
+_lock = threading.Lock()
+_calls = []
+_phases = []
+_open_phases = []
+_endpoints = {}
+_enabled = False
+_started = time.time()
+
+
+def register_endpoint(url, service):
+    """Calls to URLs starting with url are reported as the given service."""
+    with _lock:
+        _endpoints[url.rstrip('/')] = service
+
+
+def url_template(url):
+    """Returns (service, template) of URL."""
+    parsed = urlparse.urlsplit(url)
+    base = '%s://%s' % (parsed.scheme, parsed.netloc)
+    path = parsed.path
+    service = parsed.netloc
+    with _lock:
+        endpoints = _endpoints.items()
+    # the longest matching endpoint wins, Glance and Neutron can share host
+    for endpoint, name in sorted(endpoints, key=lambda e: -len(e[0])):
+        if (base + path).startswith(endpoint):
+            service = name
+            path = (base + path)[len(endpoint):]
+            break
+    segments = [ID_SEGMENT.sub(r'{id}\2', s) for s in path.split('/')]
+    template = '/'.join(segments) or '/'
+    keys = sorted(set(k for k, _ in urlparse.parse_qsl(parsed.query)))
+    if keys:
+        template += '?' + '&'.join(keys)
+    return service, template
+
+
+def record(method, url, status, latency, size, start=None):
+    service, template = url_template(url)
+    with _lock:
+        current = _open_phases[-1] if _open_phases else None
+        _calls.append(Call(service, method, template, status, latency, size,
+                           current, start))
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Marks a phase of work of a tool, for the report."""
+    start = time.time()
+    with _lock:
+        _open_phases.append(name)
+    try:
+        yield
+    finally:
+        with _lock:
+            _open_phases.remove(name)
+            _phases.append((name, start, time.time()))
+
+
+def _response_size(headers, content=None):
+    length = headers.get('content-length')
+    if length is not None and length.isdigit():
+        return int(length)
+    return len(content) if content is not None else 0
+
+
+def _wrap_requests():
+    try:
+        import requests
+    except ImportError:
+        return
+    original = requests.Session.send
+
+    def send(session, request, **kwargs):
+        start = time.time()
+        try:
+            response = original(session, request, **kwargs)
+        except Exception:
+            record(request.method, request.url, None, time.time() - start, 0,
+                   start)
+            raise
+        content = None if kwargs.get('stream') else response.content
+        record(request.method, request.url, response.status_code,
+               time.time() - start,
+               _response_size(response.headers, content), start)
+        return response
+
+    requests.Session.send = send
+
+
+def _wrap_httplib2():
+    try:
+        import httplib2
+    except ImportError:
+        return
+    original = httplib2.Http.request
+
+    def request(http, uri, method='GET', *args, **kwargs):
+        start = time.time()
+        try:
+            response, content = original(http, uri, method, *args, **kwargs)
+        except Exception:
+            record(method, uri, None, time.time() - start, 0, start)
+            raise
+        record(method, uri, response.status, time.time() - start,
+               _response_size(response, content), start)
+        return response, content
+
+    httplib2.Http.request = request
+
+
+def enable(report=True, json_file=None, tool=None):
+    """Starts recording API calls. At exit, the report is printed to stderr
+    if report is True, and calls are appended to json_file if given."""
+    global _enabled
+    with _lock:
+        if _enabled:
+            return
+        _enabled = True
+    _wrap_requests()
+    _wrap_httplib2()
+    tool = tool or os.path.basename(sys.argv[0])
+    if report:
+        atexit.register(lambda: print_report(sys.stderr))
+    if json_file:
+        atexit.register(lambda: write_json_lines(json_file, tool))
+
+
+def summary(calls=None):
+    """Returns list of (service, method, template, calls, errors, seconds,
+    max seconds, bytes), by total seconds descending."""
+    groups = collections.OrderedDict()
+    for c in calls if calls is not None else list(_calls):
+        groups.setdefault((c.service, c.method, c.template), []).append(c)
+    rows = [key + (len(cs), len([c for c in cs if not c.status or
+                                 c.status >= 400]),
+                   sum(c.latency for c in cs), max(c.latency for c in cs),
+                   sum(c.size for c in cs))
+            for key, cs in groups.items()]
+    return sorted(rows, key=lambda r: -r[5])
+
+
+def print_report(out):
+    calls = list(_calls)
+    out.write("\nAPI calls: %d taking %.2fs, %.2fs since start\n" % (
+        len(calls), sum(c.latency for c in calls), time.time() - _started))
+    out.write("%-10s %-6s %-40s %5s %4s %8s %8s %9s\n" % (
+        'service', 'method', 'template', 'calls', 'err', 'total', 'max',
+        'bytes'))
+    for service, method, template, n, errors, total, slowest, size in \
+            summary(calls):
+        out.write("%-10s %-6s %-40s %5d %4d %7.2fs %7.2fs %9d\n" % (
+            service, method, template, n, errors, total, slowest, size))
+    if _phases:
+        out.write("\n%-20s %8s %5s %8s\n" % ('phase', 'wall', 'calls',
+                                            'api'))
+        for name, start, end in sorted(_phases, key=lambda p: p[1]):
+            in_phase = [c for c in calls if c.phase == name]
+            out.write("%-20s %7.2fs %5d %7.2fs\n" % (
+                name, end - start, len(in_phase),
+                sum(c.latency for c in in_phase)))
+
+
+def write_json_lines(path, tool):
+    run = '%s-%d-%d' % (tool, os.getpid(), _started)
+    with open(path, 'a') as f:
+        for c in list(_calls):
+            f.write(json.dumps(dict(c._asdict(), type='call', tool=tool,
+                                    run=run)) + "\n")
+        for name, start, end in list(_phases):
+            f.write(json.dumps({'type': 'phase', 'tool': tool, 'run': run,
+                                'phase': name, 'start': start,
+                                'seconds': end - start}) + "\n")
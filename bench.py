@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# End-to-end benchmark of the tools against the fake cloud of fakeos.py.
+#
+# For each tenant size, the fake cloud is regenerated and the tools are run
+# one after another as they would be in a session: build_cache, n, nssh
+# -p (the lookup of nssh, the fake cloud has no sshd to connect to),
+# fastnovaboot, ndeletevms and managesecgroup. For each run the wall
+# time, number of API calls (per URL template with -v) and peak memory of the
+# process are recorded. A step exiting non-zero is reported as failed,
+# without timing, and makes the benchmark exit non-zero.
+#
+# $ ./bench.py -s 10 1000 10000 --latency 0.02
+# $ ./bench.py -s 1000 -o results.jsonl   # append results as JSON lines
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib2
+
+import cachedb
+import fakeos
+
+BENCH_TENANT = '_bench'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name prefix of the servers booted (and then deleted) by the benchmark
+BOOT_NAME = 'benchboot'
+
+# (name, command) of the benchmarked steps, in order of running
+STEPS = [
+    ('build_cache', ['build_cache.py', '-t', BENCH_TENANT]),
+    ('n', ['n.py']),
+    ('nssh -p', ['nssh.py', '-p', 'fake-0000']),
+    ('fastnovaboot', ['fastnovaboot.py', '-n', BOOT_NAME, '-c', '2',
+                      '-s', 'default', '-i', 'ubuntu-14.04',
+                      '-f', 'm1.tiny']),
+    ('ndeletevms', ['ndeletevms.py', '-s', BOOT_NAME]),
+    ('managesecgroup', ['managesecgroup.py', '-n', 'default',
+                        '-p', '22', '80', '443', '-i', '10.0.0.0/8']),
+]
+
+
+def fake_call(cloud_url, method, path, body=None):
+    request = urllib2.Request(cloud_url + path,
+                              json.dumps(body) if body is not None else None,
+                              {'Content-Type': 'application/json'})
+    request.get_method = lambda: method
+    data = urllib2.urlopen(request).read()
+    return json.loads(data) if data else None
+
+
+def run(cmd, env):
+    """Runs command, returns (exit status, seconds, peak RSS in MB)."""
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable] + cmd, stdout=devnull,
+                                stderr=devnull, env=env, cwd=HERE)
+        # wait4 gives resource usage of the finished child
+        _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    exit_status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return exit_status, time.time() - start, rusage.ru_maxrss / 1024.0
+
+
+def clean_local_state():
+    # this removes also the floating IP pool of the tenant, so the pool stays
+    # disabled (see fippool.py) and no background refill adds API calls to
+    # the stats of a step
+    for path in glob.glob(os.path.join(cachedb.CACHE_DIR,
+                                       '*_%s.*' % BENCH_TENANT)):
+        os.unlink(path)
+
+
+def bench_size(cloud_url, size, options, env, verbose):
+    fake_call(cloud_url, 'POST', '/_reset', dict(options, servers=size))
+    clean_local_state()
+    results = []
+    for name, cmd in STEPS:
+        fake_call(cloud_url, 'DELETE', '/_stats')
+        status, seconds, peak_mb = run(cmd, env)
+        stats = fake_call(cloud_url, 'GET', '/_stats')
+        result = {'size': size, 'step': name, 'status': status,
+                  'seconds': round(seconds, 3) if status == 0 else None,
+                  'peak_mb': round(peak_mb, 1),
+                  'api_calls': stats['total'],
+                  'calls': dict((t, s['count'])
+                                for t, s in stats['calls'].items())}
+        results.append(result)
+        if status == 0:
+            print "%7d %-16s %8.2fs %6d calls %7.1f MB" % (
+                size, name, seconds, stats['total'], peak_mb)
+        else:
+            print "%7d %-16s   FAILED (exit %d)" % (size, name, status)
+        if verbose:
+            for template, count in sorted(result['calls'].items()):
+                print "%33s %5d  %s" % ('', count, template)
+    return results
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='benchmark of the tools against a fake OpenStack')
+
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[10, 1000], help='servers in the tenant')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds of latency of each API call')
+    parser.add_argument('--item-latency', type=float, default=0.0,
+                        help='seconds of latency per item in listings')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of API calls failing with 503')
+    parser.add_argument('-o', '--output',
+                        help='append results to this file as JSON lines')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show API calls per URL template')
+
+    return parser.parse_args(args_list)
+
+
+def main(args_list):
+    args = get_args(args_list)
+    options = {'latency': args.latency, 'item_latency': args.item_latency,
+               'error_rate': args.error_rate, 'error_codes': [503],
+               'build_time': 2.0, 'delete_time': 1.0}
+    server = fakeos.start(options)
+    cloud_url = server.cloud.url
+    env = dict(os.environ, OS_AUTH_URL=cloud_url + '/v2.0',
+               OS_USERNAME='bench', OS_PASSWORD='bench',
+               OS_TENANT_NAME=BENCH_TENANT,
+               OS_TENANT_ID=fakeos.tenant_id(BENCH_TENANT))
+
+    results = []
+    try:
+        for size in args.sizes:
+            results += bench_size(cloud_url, size, options, env,
+                                  args.verbose)
+    finally:
+        clean_local_state()
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for r in results:
+                r['time'] = time.time()
+                f.write(json.dumps(r) + "\n")
+    failed = [r for r in results if r['status'] != 0]
+    if failed:
+        print >> sys.stderr, "%d steps failed: %s" % (
+            len(failed), ', '.join('%s (%d servers)' % (r['step'], r['size'])
+                                   for r in failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Startup-time benchmark of the tools that work from the local cache.
+#
+# It builds a small cache for a dummy tenant, runs each command several times
+# in a fresh interpreter and prints median wall time. It also checks that
+# none of the OpenStack client libraries gets imported on the way, and exits
+# with 1 if a command is slower than --max-ms, so it can be run in CI or
+# before a commit.
+#
+# $ ./bench_startup.py -r 20 --max-ms 50
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import cachedb
+import util
+
+BENCH_TENANT = '_bench_startup'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CLIENT_MODULES = ['novaclient', 'glanceclient', 'keystoneclient',
+                  'neutronclient']
+
+# (name, command, whether --max-ms applies)
+COMMANDS = [
+    ('python', [sys.executable, '-c', 'pass'], False),
+    ('import util', [sys.executable, '-c', 'import util'], False),
+    ('import build_cache', [sys.executable, '-c', 'import build_cache'],
+     False),
+    ('n', [sys.executable, os.path.join(HERE, 'n.py')], True),
+    ('n --names', [sys.executable, os.path.join(HERE, 'n.py'), '--names'],
+     True),
+]
+
+CHECK_IMPORTS = ("import sys, util, build_cache, n; "
+                 "print ' '.join(m for m in sys.modules "
+                 "if m.split('.')[0] in %r)" % CLIENT_MODULES)
+
+
+def make_cache(instances):
+    util.mkdirp(cachedb.CACHE_DIR)
+    w = cachedb.CacheWriter(BENCH_TENANT)
+    for n in range(instances):
+        w.add_instance('%08d-0000-0000-0000-000000000000' % n,
+                       'benchtest-%04x' % n, 'ACTIVE', 'image',
+                       {'fixed': ['192.168.%d.%d' % (n / 256 % 256, n % 256)],
+                        'floating': []})
+    w.publish()
+
+
+def bench(cmd, runs, env):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(cmd, stdout=devnull, env=env, cwd=HERE)
+            times.append((time.time() - start) * 1000)
+    return sorted(times)[len(times) / 2]
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='startup-time benchmark of cache-only tools')
+
+    parser.add_argument('-r', '--runs', help='runs of each command',
+                        type=int, default=10)
+    parser.add_argument('-n', '--instances', type=int, default=200,
+                        help='number of instances in the benchmark cache')
+    parser.add_argument('--max-ms', type=float, default=50,
+                        help='fail if median of a tool is slower')
+
+    return parser.parse_args(args_list)
+
+
+def main(args_list):
+    args = get_args(args_list)
+    env = dict(os.environ, OS_TENANT_NAME=BENCH_TENANT)
+    for var in ['OS_USERNAME', 'OS_PASSWORD', 'OS_AUTH_URL']:
+        env.pop(var, None)
+
+    make_cache(args.instances)
+    failed = False
+    try:
+        imported = subprocess.check_output(
+            [sys.executable, '-c', CHECK_IMPORTS], env=env, cwd=HERE).strip()
+        if imported:
+            print "FAIL: client modules imported at startup: %s" % imported
+            failed = True
+
+        baseline = None
+        for name, cmd, limited in COMMANDS:
+            median = bench(cmd, args.runs, env)
+            if baseline is None:
+                baseline = median
+                print "%-20s %7.1f ms" % (name, median)
+                continue
+            slow = limited and median > args.max_ms
+            failed = failed or slow
+            print "%-20s %7.1f ms (+%.1f ms over bare python)%s" % (
+                name, median, median - baseline, ' FAIL' if slow else '')
+    finally:
+        os.unlink(cachedb.DB_FILE % BENCH_TENANT)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
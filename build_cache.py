@@ -7,60 +7,361 @@
 # put this in yout crontab to run each 5 minutes as
 # */5 * * * * . /home/tomk/os/openrc.sh && /home/tomk/bin/openstack-utils/build_cache.py
 
+# All tenants and all resource kinds are fetched concurrently by a bounded
+# pool of workers (see --workers). Each tenant authenticates only once. A lock
+# file makes sure two runs never overlap; if a previous run is still going,
+# the new one just quits.
+
+# The cache is a SQLite database per tenant (see cachedb.py). The older
+# space-separated text files are written too if you pass --text.
+
+# With --incremental, only resources changed since the last run are fetched
+# from Nova and Glance (including deleted ones) and merged into the existing
+# cache. A full resync is done every FULL_SYNC_INTERVAL seconds, or when the
+# number of cached instances doesn't match what Nova reports.
+
+# With --inventory, the tenants of all clouds and regions in the inventory
+# file (see inventory.py) are cached concurrently, each under its own
+# cloud:region:tenant name, for n --all and nssh --all.
+
+# Each instance is indexed by all its fixed and floating addresses (of all
+# its networks) and the Forge hostnames of the floating ones, so that n -i
+# and nssh find an instance by address with one lookup.
+
+# Servers and images are listed page by page (--page-size) and each page goes
+# to the cache writer as it arrives, so memory use doesn't grow with the size
+# of the tenant.
+
 # needs python-{nova,glance}client
 
 import util
+import cachedb
+import inventory
+import argparse
 import json
 import errno
+import fcntl
 import os
 import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
-CACHE_DIR = '/tmp/os_cache'
+CACHE_DIR = cachedb.CACHE_DIR
 INSTANCES_CACHE_FILE = CACHE_DIR + '/instances_%s'
 SECGROUPS_CACHE_FILE = CACHE_DIR + '/secgroups_%s'
 IMAGES_CACHE_FILE = CACHE_DIR + '/images_%s'
+LOCK_FILE = CACHE_DIR + '/.build_cache.lock'
 TENANTS = ['provisiontest', 'digile']
 
+# number of concurrent API fetches
+WORKERS = 8
+
+# in incremental mode, do full resync of a resource kind after this many
+# seconds
+FULL_SYNC_INTERVAL = 3600
+
+# changes-since window starts this many seconds before the last sync, to
+# allow for clock skew between us and the API servers
+SYNC_OVERLAP = 60
+
+# servers and images are listed in pages of this many items. Nova caps pages
+# at its osapi_max_limit (1000 by default), so a page can be shorter than
+# this; only an empty page ends the listing.
+PAGE_SIZE = 500
+
+i = util.logger.info
+d = util.logger.debug
+
 
 def getAddrs(vm):
-    addrs = getattr(vm, 'addresses')
-    fixed = [ x['addr'] for x
-                in addrs.itervalues().next()
-                if x['OS-EXT-IPS:type'] == 'fixed'
-              ]
-    floating  = [ x['addr'] for x
-                in addrs.itervalues().next()
-                if x['OS-EXT-IPS:type'] == 'floating'
-              ]
-    return {'fixed': fixed, 'floating': floating}
-
-def mkdirp(path):
+    # addresses of all networks of the vm, and Forge hostnames of the
+    # floating ones, for the reverse index of the cache
+    addrs = [ x for network in sorted(getattr(vm, 'addresses'))
+                for x in vm.addresses[network]
+            ]
+    fixed = [ x['addr'] for x in addrs
+                if x.get('OS-EXT-IPS:type', 'fixed') == 'fixed'
+            ]
+    floating  = [ x['addr'] for x in addrs
+                if x.get('OS-EXT-IPS:type') == 'floating'
+                ]
+    return {'fixed': fixed, 'floating': floating,
+            'hostname': [util.forge_hostname(a) for a in floating]}
+
+def getSecgroupNames(vm):
+    # servers in ERROR state may come without security groups
+    return sorted(set(sg['name'] for sg in
+                      getattr(vm, 'security_groups', None) or []))
+
+def acquire_lock(path):
+    """Returns open lock file, or None if other process holds the lock."""
+    lock_file = open(path, 'w')
     try:
-        os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as exc:
+        lock_file.close()
+        if exc.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_file
+
+
+def total_instances_used(nova):
+    for limit in nova.limits.get().absolute:
+        if limit.name == 'totalInstancesUsed':
+            return limit.value
+    return None
+
+
+def iter_servers(nova, search_opts=None, page_size=PAGE_SIZE):
+    """Yields servers, listed page by page with limit and marker, so that
+    only one page is held in memory. Nova caps pages to osapi_max_limit, so
+    a short page doesn't mean the end, only an empty one does."""
+    opts = dict(search_opts or {}, limit=page_size)
+    while True:
+        page = nova.servers.list(search_opts=opts)
+        if not page or page[-1].id == opts.get('marker'):
+            return
+        for s in page:
+            yield s
+        opts['marker'] = page[-1].id
+
+
+def cache_instances(session, writer, since=None, page_size=PAGE_SIZE):
+    nova = session.nova()
+    if since is None:
+        writer.clear('instances')
+        for s in iter_servers(nova, page_size=page_size):
+            writer.add_instance(s.id, s.name, s.status, s.image['id'],
+                                getAddrs(s), getSecgroupNames(s))
+        return
+
+    # changes-since lists also the instances deleted in the meantime
+    changed = 0
+    for s in iter_servers(nova, {'changes-since': util.iso_time(since)},
+                          page_size):
+        changed += 1
+        if s.status in ('DELETED', 'SOFT_DELETED'):
+            writer.remove_instance(s.id)
+        else:
+            writer.add_instance(s.id, s.name, s.status, s.image['id'],
+                                getAddrs(s), getSecgroupNames(s))
+    d("%d instances of tenant %s changed since %s" %
+      (changed, session.tenant, util.iso_time(since)))
+
+    used = total_instances_used(nova)
+    if used is not None and used != writer.count('instances'):
+        i("Cache of tenant %s has %d instances, but Nova reports %d. Doing "
+          "full resync." % (session.tenant, writer.count('instances'), used))
+        cache_instances(session, writer, page_size=page_size)
+
+
+def cache_secgroups(session, writer, since=None, page_size=PAGE_SIZE):
+    # Nova doesn't do changes-since for security groups, they are always
+    # listed completely. There are not many of them.
+    writer.clear('secgroups')
+    for g in session.nova().security_groups.list():
+        writer.add_secgroup(g.id, g.name, g.description, g.rules)
+
+
+def cache_images(session, writer, since=None, page_size=PAGE_SIZE):
+    # glanceclient fetches the pages lazily, as the listing is iterated
+    glance = session.glance()
+    if since is None:
+        writer.clear('images')
+        for img in glance.images.list(page_size=page_size):
+            writer.add_image(img.id, img.name)
+        return
+
+    changed = 0
+    for img in glance.images.list(
+            page_size=page_size,
+            filters={'changes-since': util.iso_time(since)}):
+        changed += 1
+        if getattr(img, 'deleted', False) or img.status == 'deleted':
+            writer.remove_image(img.id)
         else:
-            raise
+            writer.add_image(img.id, img.name)
+    d("%d images of tenant %s changed since %s" %
+      (changed, session.tenant, util.iso_time(since)))
+
+
+CACHE_KINDS = [('instances', cache_instances),
+               ('secgroups', cache_secgroups),
+               ('images', cache_images)]
+
+
+def _atomic_write(path, lines):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        for l in lines:
+            f.write(l + "\n")
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
+
+
+def write_text_files(tenant):
+    """Writes the old text format of the cache from the published database.
+    """
+    cache = cachedb.Cache(tenant)
+    _atomic_write(INSTANCES_CACHE_FILE % tenant,
+        ("%s %s %s" % (s['id'], s['name'], json.dumps(
+            {'fixed': s['fixed'].split(), 'floating': s['floating'].split()}))
+         for s in cache.instances()))
+    _atomic_write(SECGROUPS_CACHE_FILE % tenant,
+        ("%s %s" % (g['name'], g['description'].replace(' ', '_'))
+         for g in cache.secgroups()))
+    _atomic_write(IMAGES_CACHE_FILE % tenant,
+        ("%s %s" % (img['id'], img['name'].replace(' ', '_'))
+         for img in cache.images()))
+
+
+def _sync_since(writer, kind, full_interval):
+    """Returns time for changes-since of a resource kind, None for full sync.
+    """
+    if not writer.incremental:
+        return None
+    last_full = writer.meta('full_sync_%s' % kind)
+    last_sync = writer.meta('sync_%s' % kind)
+    if last_full is None or last_sync is None:
+        return None
+    if time.time() - float(last_full) > full_interval:
+        return None
+    return float(last_sync) - SYNC_OVERLAP
+
+
+def _timed(func, session, writer, kind, since, page_size):
+    start = time.time()
+    try:
+        func(session, writer, since, page_size)
+    except Exception as e:
+        util.logger.error("Caching for tenant %s failed: %s"
+                          % (writer.tenant, e))
+        return None
+    writer.set_meta('sync_%s' % kind, start)
+    if since is None:
+        writer.set_meta('full_sync_%s' % kind, start)
+    return time.time() - start
+
+
+def refresh(tenants, workers=WORKERS, text=False, incremental=False,
+            full_interval=FULL_SYNC_INTERVAL, sessions=None,
+            page_size=PAGE_SIZE):
+    """Refreshes cache of all resource kinds of given tenants concurrently.
+
+    Cache of a tenant is published only if all its resource kinds were
+    fetched. Returns dict tenant -> {kind: seconds}. Time of a failed fetch
+    is None. sessions is dict tenant -> util.TenantSession to reuse.
+    Servers and images are listed in pages of page_size.
+    """
+    pool = ThreadPool(workers)
+    try:
+        pending = []
+        for t in tenants:
+            session = (sessions or {}).get(t) or util.TenantSession(t)
+            writer = cachedb.CacheWriter(t, incremental=incremental)
+            results = [(kind, pool.apply_async(_timed, (func, session, writer,
+                           kind, _sync_since(writer, kind, full_interval),
+                           page_size)))
+                       for kind, func in CACHE_KINDS]
+            pending.append((t, writer, results))
+        timings = {}
+        for tenant, writer, results in pending:
+            timings[tenant] = dict((k, r.get()) for k, r in results)
+            if None in timings[tenant].values():
+                writer.discard()
+                continue
+            writer.publish()
+            if text:
+                write_text_files(tenant)
+    finally:
+        pool.close()
+        pool.join()
+    return timings
+
+
+def print_summary(timings, total):
+    fmt = "%-24s" + " %10s" * len(CACHE_KINDS)
+    i("Cache refresh took %.2fs:\n%s\n%s" % (total,
+        fmt % tuple(['tenant'] + [k for k, _ in CACHE_KINDS]),
+        "\n".join(fmt % tuple([t] + [
+                      'FAILED' if timings[t][k] is None
+                      else '%.2fs' % timings[t][k]
+                      for k, _ in CACHE_KINDS])
+                  for t in sorted(timings))))
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Build local cache of OpenStack resources')
+
+    help_workers = 'number of concurrent API fetches'
+    help_tenants = ('tenants to cache, %s if not given. With --inventory, '
+                    'names of its targets to cache, all if not given'
+                    % ' '.join(TENANTS))
+    help_text = ('also write the old text files (instances_<tenant>, ..) '
+                 'for tools that read them')
+    help_incremental = ('fetch only resources changed since last run and '
+                        'merge them to the existing cache')
+    help_full_every = ('in incremental mode, do full resync after this many '
+                       'seconds')
+    help_page_size = ('list servers and images in pages of this many '
+                      'items')
+    help_inventory = ('cache all clouds, regions and tenants of inventory '
+                      'FILE, or the ones of them given in --tenants')
+    help_lock = ('lock file, runs with the same lock file never overlap')
+
+    parser.add_argument('-w', '--workers', help=help_workers, type=int,
+                        default=WORKERS)
+    parser.add_argument('-t', '--tenants', help=help_tenants, nargs='+')
+    parser.add_argument('--text', help=help_text, action='store_true')
+    parser.add_argument('-i', '--incremental', help=help_incremental,
+                        action='store_true')
+    parser.add_argument('--full-every', help=help_full_every, type=int,
+                        default=FULL_SYNC_INTERVAL)
+    parser.add_argument('-p', '--page-size', help=help_page_size, type=int,
+                        default=PAGE_SIZE)
+    parser.add_argument('--inventory', help=help_inventory, metavar='FILE',
+                        nargs='?', const=inventory.INVENTORY_FILE)
+    parser.add_argument('--lock', help=help_lock, metavar='FILE',
+                        default=LOCK_FILE)
+    util.add_profile_args(parser)
+
+    return parser.parse_args(args_list)
+
 
 def main(args_list):
-    mkdirp(CACHE_DIR)
-
-    util.reuse_proxies = False
-
-    for t in TENANTS:
-        util._TENANT = t
-        _nova_prox = util.NovaProxy()
-        with open(INSTANCES_CACHE_FILE % t, 'w') as f:
-            for s in _nova_prox.servers.list():
-                f.write("%s %s %s\n" % (s.id, s.name, json.dumps(getAddrs(s))))
-        with open(SECGROUPS_CACHE_FILE % t, 'w') as f:
-            for g in _nova_prox.security_groups.list():
-                f.write("%s %s\n" % (g.name, g.description.replace(' ','_')))
-        _glance_prox = util.GlanceProxy()
-        with open(IMAGES_CACHE_FILE % t, 'w') as f:
-            for i in _glance_prox.images.list():
-                f.write("%s %s\n" % (i.id, i.name.replace(' ','_')))
+    args = get_args(args_list)
+    util.setup_profile(args)
+    # each worker can keep its connection
+    util.share_http_pool(args.workers)
+    util.mkdirp(CACHE_DIR)
+
+    tenants, sessions = args.tenants or TENANTS, None
+    if args.inventory:
+        sessions = inventory.sessions(args.inventory)
+        tenants = args.tenants or sessions.keys()
+        unknown = set(tenants) - set(sessions)
+        if unknown:
+            raise util.NovaWrapperError("%s not in inventory %s" % (
+                ', '.join(sorted(unknown)), args.inventory))
+
+    lock = acquire_lock(args.lock)
+    if lock is None:
+        i("Another cache refresh is still running, quitting.")
+        return 0
+
+    with lock:
+        start = time.time()
+        timings = refresh(tenants, max(1, args.workers), args.text,
+                          args.incremental, args.full_every, sessions,
+                          max(1, args.page_size))
+        print_summary(timings, time.time() - start)
+
+    failed = [t for t in timings if None in timings[t].values()]
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
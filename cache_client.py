@@ -0,0 +1,111 @@
+"""
+Client of the cache daemon (see cache_daemon.py).
+
+The daemon answers lookups over a Unix socket, one JSON object per line in
+each direction. DaemonCache has the read interface of cachedb.Cache, and
+open_cache() returns it when the daemon serves the tenant, otherwise the
+on-disk cache. Like cachedb, this module imports nothing heavy, so that n
+and shell completion stay fast.
+"""
+
+import json
+import socket
+
+import cachedb
+
+SOCKET_PATH = cachedb.CACHE_DIR + '/cache_daemon.sock'
+
+# seconds to wait for the daemon before falling back to the on-disk cache
+TIMEOUT = 2
+
+
+def _to_str(value):
+    # rows from the on-disk cache have str values, keep it that way
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in value.items())
+    return value
+
+
+class DaemonCache(object):
+    """Read access to the cache of a tenant kept by the daemon."""
+
+    def __init__(self, tenant, path=SOCKET_PATH, timeout=TIMEOUT):
+        self.tenant = tenant
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+        except socket.error as e:
+            self._sock.close()
+            raise cachedb.CacheError("No cache daemon on %s: %s" % (path, e))
+        self._file = self._sock.makefile('rb')
+        try:
+            self.updated = self.query('status')['updated']
+        except cachedb.CacheError:
+            self.close()
+            raise
+
+    def query(self, op, **params):
+        """Sends request to the daemon, returns its result."""
+        params.update(op=op, tenant=self.tenant)
+        try:
+            self._sock.sendall(json.dumps(params) + "\n")
+            line = self._file.readline()
+        except socket.error as e:
+            raise cachedb.CacheError("Cache daemon failed: %s" % e)
+        if not line:
+            raise cachedb.CacheError("Cache daemon closed the connection")
+        response = json.loads(line)
+        if not response['ok']:
+            raise cachedb.CacheError(response['error'])
+        return _to_str(response['result'])
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def refresh(self):
+        """Asks the daemon to refresh the tenant now, returns when it's done.
+        """
+        timeout = self._sock.gettimeout()
+        # refresh takes as long as the API calls
+        self._sock.settimeout(None)
+        try:
+            self.updated = self.query('refresh')['updated']
+        finally:
+            self._sock.settimeout(timeout)
+
+    def instances(self, name=None):
+        return self.query('instances', name=name)
+
+    def instance(self, instance_id):
+        return self.query('instance', id=instance_id)
+
+    def instances_by_address(self, address):
+        return self.query('address', address=address)
+
+    def image(self, image_id):
+        return self.query('image', id=image_id)
+
+    def images(self):
+        return self.query('images')
+
+    def secgroups(self):
+        return self.query('secgroups')
+
+    def secgroup_rules(self):
+        return [(r['id'], r['name'], json.loads(r['rules'] or '[]'))
+                for r in self.secgroups()]
+
+
+def open_cache(tenant):
+    """Returns DaemonCache of tenant if the daemon serves it, otherwise
+    cachedb.Cache. Raises cachedb.CacheError if there's neither."""
+    try:
+        return DaemonCache(tenant)
+    except cachedb.CacheError:
+        return cachedb.Cache(tenant)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+# Daemon keeping the cache of OpenStack resources in memory.
+#
+# It refreshes the cache of given tenants every --interval seconds (or when a
+# client asks for it) with build_cache.refresh, incrementally and with the
+# same Keystone sessions all the time. The on-disk cache is written as
+# before, and then loaded into memory. Instances and images are indexed by
+# id, and instances also by address; name lookups scan the instances.
+#
+# Lookups are served over a Unix socket (cache_client.SOCKET_PATH), one JSON
+# object per line:
+#
+#   {"op": "instances", "tenant": "t", "name": "web"}
+#   -> {"ok": true, "result": [{"id": .., "name": .., ..}, ..]}
+#
+# ops: status, refresh, instances (name optional), instance (id), address
+# (fixed or floating IP, or Forge hostname), images, image (id), secgroups.
+# Rows have the columns of the tables in cachedb.py. n and nssh ask the
+# daemon first (see cache_client.open_cache) and read the on-disk cache if
+# it's not running.
+#
+# $ cache_daemon.py -t provisiontest digile -i 60 &
+#
+# With --inventory, it serves all targets of the inventory (see inventory.py)
+# under their cloud:region:tenant names.
+
+import argparse
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+import build_cache
+import cache_client
+import cachedb
+import inventory
+import util
+
+i = util.logger.info
+d = util.logger.debug
+
+# seconds between refreshes
+INTERVAL = 60
+
+
+class TenantState(object):
+    """Cache of a tenant loaded into memory."""
+
+    def __init__(self, tenant):
+        cache = cachedb.Cache(tenant)
+        try:
+            self.updated = cache.updated
+            self.instances = [dict(r) for r in cache.instances()]
+            self.images = [dict(r) for r in cache.images()]
+            self.secgroups = [dict(r) for r in cache.secgroups()]
+        finally:
+            cache.close()
+        self.by_id = dict((r['id'], r) for r in self.instances)
+        self.by_address = {}
+        for r in self.instances:
+            floating = r['floating'].split()
+            for address in set(r['fixed'].split() + floating +
+                               [util.forge_hostname(a) for a in floating]):
+                self.by_address.setdefault(address, []).append(r)
+        self.images_by_id = dict((r['id'], r) for r in self.images)
+
+    def query(self, op, params):
+        if op == 'status':
+            return {'updated': self.updated,
+                    'instances': len(self.instances),
+                    'images': len(self.images),
+                    'secgroups': len(self.secgroups)}
+        if op == 'instances':
+            name = params.get('name')
+            if name is None:
+                return self.instances
+            return [r for r in self.instances if name in r['name']]
+        if op == 'instance':
+            return self.by_id.get(params['id'])
+        if op == 'address':
+            return self.by_address.get(params['address'].lower(), [])
+        if op == 'images':
+            return self.images
+        if op == 'image':
+            return self.images_by_id.get(params['id'])
+        if op == 'secgroups':
+            return self.secgroups
+        raise ValueError("Unknown op %s" % op)
+
+
+class Refresher(object):
+    """Refreshes the tenants periodically or on demand, keeps their
+    TenantState."""
+
+    def __init__(self, tenants, interval, workers, full_interval,
+                 sessions=None):
+        self.tenants = tenants
+        self.interval = interval
+        self.workers = workers
+        self.full_interval = full_interval
+        self.sessions = sessions or dict((t, util.TenantSession(t))
+                                         for t in tenants)
+        self.states = {}
+        self.rounds = 0
+        self._cond = threading.Condition()
+        self._requested = False
+        self._running = False
+
+    def load(self):
+        for t in self.tenants:
+            try:
+                self.states[t] = TenantState(t)
+            except cachedb.CacheError as e:
+                d(str(e))
+
+    def refresh(self):
+        lock = build_cache.acquire_lock(build_cache.LOCK_FILE)
+        if lock is None:
+            i("Another cache refresh is running, reloading its result later")
+        else:
+            with lock:
+                start = time.time()
+                timings = build_cache.refresh(
+                    self.tenants, self.workers, incremental=True,
+                    full_interval=self.full_interval, sessions=self.sessions)
+                build_cache.print_summary(timings, time.time() - start)
+        self.load()
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._running = True
+            try:
+                self.refresh()
+            except Exception as e:
+                util.logger.error("Cache refresh failed: %s" % e)
+            with self._cond:
+                self._running = False
+                self.rounds += 1
+                self._cond.notify_all()
+                if not self._requested:
+                    self._cond.wait(self.interval)
+                self._requested = False
+
+    def request_refresh(self):
+        """Triggers refresh and waits until it's done."""
+        with self._cond:
+            # a refresh which is running already may have missed changes
+            target = self.rounds + (2 if self._running else 1)
+            self._requested = True
+            self._cond.notify_all()
+            while self.rounds < target:
+                self._cond.wait()
+
+    def query(self, request):
+        tenant = request.get('tenant')
+        if tenant not in self.tenants:
+            raise ValueError("Tenant %s is not cached by the daemon" % tenant)
+        if request['op'] == 'refresh':
+            self.request_refresh()
+            request = dict(request, op='status')
+        state = self.states.get(tenant)
+        if state is None:
+            raise ValueError("Cache of tenant %s is not built yet" % tenant)
+        return state.query(request['op'], request)
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                response = {'ok': True,
+                            'result': self.server.refresher.query(
+                                json.loads(line))}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, refresher):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # left over from a daemon which didn't exit cleanly
+                os.unlink(path)
+            else:
+                raise util.NovaWrapperError("Cache daemon is already "
+                                            "running on %s" % path)
+            finally:
+                probe.close()
+        # the cache is readable only by the current user
+        old_umask = os.umask(0077)
+        try:
+            SocketServer.ThreadingUnixStreamServer.__init__(self, path,
+                                                            Handler)
+        finally:
+            os.umask(old_umask)
+        self.refresher = refresher
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Keep cache of OpenStack resources in memory and serve '
+                    'it over a Unix socket')
+
+    help_interval = 'seconds between refreshes'
+
+    parser.add_argument('-t', '--tenants', help='tenants to cache',
+                        nargs='+', default=build_cache.TENANTS)
+    parser.add_argument('-i', '--interval', help=help_interval, type=int,
+                        default=INTERVAL)
+    parser.add_argument('-w', '--workers', help='number of concurrent API '
+                        'fetches', type=int, default=build_cache.WORKERS)
+    parser.add_argument('--full-every', help='do full resync after this '
+                        'many seconds', type=int,
+                        default=build_cache.FULL_SYNC_INTERVAL)
+    parser.add_argument('-s', '--socket', help='path of the socket',
+                        default=cache_client.SOCKET_PATH)
+    parser.add_argument('--inventory', help='cache all clouds, regions and '
+                        'tenants of inventory FILE instead of --tenants',
+                        metavar='FILE', nargs='?',
+                        const=inventory.INVENTORY_FILE)
+    util.add_profile_args(parser)
+
+    return parser.parse_args(args_list)
+
+
+def main(args_list):
+    args = get_args(args_list)
+    util.setup_profile(args)
+    util.share_http_pool(args.workers)
+    util.mkdirp(cachedb.CACHE_DIR)
+
+    tenants, sessions = args.tenants, None
+    if args.inventory:
+        sessions = inventory.sessions(args.inventory)
+        tenants = sessions.keys()
+
+    refresher = Refresher(tenants, args.interval, max(1, args.workers),
+                          args.full_every, sessions)
+    # serve the existing on-disk cache until the first refresh is done
+    refresher.load()
+    thread = threading.Thread(target=refresher.run)
+    thread.daemon = True
+    thread.start()
+
+    server = Server(args.socket, refresher)
+    i("Serving cache of %s on %s" % (', '.join(tenants), args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,232 @@
+"""
+On-disk cache of OpenStack resources of a tenant.
+
+The cache is a SQLite database per tenant, with indexes on instance id and
+address (fixed, floating or hostname), so that nssh can answer lookups by id
+or address without scanning the whole cache. Names are matched as
+substrings, which no index helps with. build_cache.py writes the cache to a
+temporary file and renames it into place, so readers never see a
+half-written cache.
+
+For incremental refreshes the writer starts from a copy of the published
+cache and changed resources are merged into it.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = '/tmp/os_cache'
+DB_FILE = CACHE_DIR + '/cache_%s.db'
+
+# bump when the schema changes, readers refuse caches of other versions
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE instances (id TEXT PRIMARY KEY, name TEXT, status TEXT,
+                        image_id TEXT, fixed TEXT, floating TEXT,
+                        secgroups TEXT);
+CREATE TABLE addresses (address TEXT, type TEXT, instance_id TEXT);
+CREATE INDEX addresses_address ON addresses (address);
+CREATE INDEX addresses_instance ON addresses (instance_id);
+CREATE TABLE secgroups (id TEXT PRIMARY KEY, name TEXT, description TEXT,
+                        rules TEXT);
+CREATE INDEX secgroups_name ON secgroups (name);
+CREATE TABLE images (id TEXT PRIMARY KEY, name TEXT);
+CREATE INDEX images_name ON images (name);
+"""
+
+
+# kinds of addresses in the addresses table
+ADDRESS_TYPES = ('fixed', 'floating', 'hostname')
+
+
+class CacheError(Exception):
+    pass
+
+
+class CacheWriter(object):
+    """Builds a new cache of a tenant in a temporary file.
+
+    The add_*, remove_* and clear methods can be called from multiple
+    threads. The cache becomes visible to readers only after publish().
+
+    With incremental=True the writer starts from the published cache of the
+    tenant (if there's a usable one, see the "incremental" attribute).
+    """
+
+    def __init__(self, tenant, path=None, incremental=False):
+        self.tenant = tenant
+        self.path = path or DB_FILE % tenant
+        self.tmp_path = '%s.tmp.%d' % (self.path, os.getpid())
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+        self.incremental = False
+        if incremental:
+            try:
+                Cache(tenant, self.path).close()
+                shutil.copyfile(self.path, self.tmp_path)
+                self.incremental = True
+            except CacheError:
+                pass
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.tmp_path, check_same_thread=False)
+        # the file is not visible to anyone until it's complete
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        if not self.incremental:
+            self._db.executescript(SCHEMA)
+            self._set_meta('version', SCHEMA_VERSION)
+            self._set_meta('tenant', tenant)
+
+    def _set_meta(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         (key, str(value)))
+
+    def meta(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                                   (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._set_meta(key, value)
+
+    def count(self, table):
+        with self._lock:
+            return self._db.execute('SELECT count(*) FROM %s' % table
+                                    ).fetchone()[0]
+
+    def clear(self, table):
+        """Removes all resources of a kind ("instances", "images", ..)."""
+        with self._lock:
+            self._db.execute('DELETE FROM %s' % table)
+            if table == 'instances':
+                self._db.execute('DELETE FROM addresses')
+
+    def _remove_instance(self, instance_id):
+        self._db.execute('DELETE FROM instances WHERE id = ?', (instance_id,))
+        self._db.execute('DELETE FROM addresses WHERE instance_id = ?',
+                         (instance_id,))
+
+    def remove_instance(self, instance_id):
+        with self._lock:
+            self._remove_instance(instance_id)
+
+    def remove_image(self, image_id):
+        with self._lock:
+            self._db.execute('DELETE FROM images WHERE id = ?', (image_id,))
+
+    def add_instance(self, instance_id, name, status, image_id, addrs,
+                     secgroups=()):
+        """addrs is dict as returned from build_cache.getAddrs, its
+        "fixed", "floating" and "hostname" addresses are indexed. secgroups
+        are names of security groups of the instance."""
+        with self._lock:
+            if self.incremental:
+                self._remove_instance(instance_id)
+            self._db.execute(
+                'INSERT OR REPLACE INTO instances '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (instance_id, name, status, image_id,
+                 ' '.join(addrs['fixed']), ' '.join(addrs['floating']),
+                 json.dumps(list(secgroups))))
+            self._db.executemany(
+                'INSERT INTO addresses VALUES (?, ?, ?)',
+                [(a, t, instance_id) for t in ADDRESS_TYPES
+                 for a in addrs.get(t, [])])
+
+    def add_secgroup(self, secgroup_id, name, description, rules=()):
+        """rules are the rule dicts of the group, Nova or Neutron format."""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO secgroups VALUES (?, ?, ?, ?)',
+                (secgroup_id, name, description, json.dumps(list(rules))))
+
+    def add_image(self, image_id, name):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO images VALUES (?, ?)',
+                             (image_id, name))
+
+    def publish(self):
+        with self._lock:
+            self._set_meta('updated', time.time())
+            self._db.commit()
+            self._db.close()
+            os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        with self._lock:
+            self._db.close()
+            os.unlink(self.tmp_path)
+
+
+class Cache(object):
+    """Read access to the cache of a tenant."""
+
+    def __init__(self, tenant, path=None):
+        self.tenant = tenant
+        self.path = path or DB_FILE % tenant
+        if not os.path.isfile(self.path):
+            raise CacheError("No cache for tenant %s in %s, run build_cache.py"
+                             % (tenant, self.path))
+        self._db = sqlite3.connect(self.path)
+        self._db.row_factory = sqlite3.Row
+        self._db.text_factory = str
+        version = self.meta('version')
+        if version != str(SCHEMA_VERSION):
+            raise CacheError("Cache %s has version %s, expected %s. Re-run "
+                             "build_cache.py" % (self.path, version,
+                                                 SCHEMA_VERSION))
+
+    def close(self):
+        self._db.close()
+
+    def meta(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                               (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def updated(self):
+        """Time when the cache was published (seconds since epoch)."""
+        return float(self.meta('updated'))
+
+    def instances(self, name=None):
+        """All instances, or the ones with name containing given substring."""
+        if name is None:
+            return self._db.execute('SELECT * FROM instances').fetchall()
+        return self._db.execute(
+            "SELECT * FROM instances WHERE instr(name, ?) > 0",
+            (name,)).fetchall()
+
+    def instance(self, instance_id):
+        return self._db.execute('SELECT * FROM instances WHERE id = ?',
+                                (instance_id,)).fetchone()
+
+    def instances_by_address(self, address):
+        """Instances with given fixed or floating IP or Forge hostname."""
+        return self._db.execute(
+            'SELECT DISTINCT instances.* FROM addresses JOIN instances '
+            'ON addresses.instance_id = instances.id '
+            'WHERE addresses.address = ?', (address.lower(),)).fetchall()
+
+    def image(self, image_id):
+        return self._db.execute('SELECT * FROM images WHERE id = ?',
+                                (image_id,)).fetchone()
+
+    def images(self):
+        return self._db.execute('SELECT * FROM images').fetchall()
+
+    def secgroups(self):
+        return self._db.execute('SELECT * FROM secgroups').fetchall()
+
+    def secgroup_rules(self):
+        """Returns list of (id, name, rules) of all security groups."""
+        return [(r['id'], r['name'], json.loads(r['rules'] or '[]'))
+                for r in self.secgroups()]
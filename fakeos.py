@@ -0,0 +1,870 @@
+#!/usr/bin/env python
+
+"""
+Fake OpenStack API for running the tools locally.
+
+Implements the parts of Keystone v2, Nova v1.1/v2, Glance v1 and Neutron v2
+which the tools in this repo use, with generated tenants of configurable
+size. Servers go through BUILD to ACTIVE and get their fixed IP on the way,
+deleted servers disappear after a while, so waiting code is exercised too.
+
+Every response can be delayed (--latency, plus --item-latency per listed
+item) and a share of calls can fail with given HTTP codes (--error-rate,
+--error-codes, --error-path). Nova listings are capped at --max-limit items
+per call like in real Nova.
+
+Floating IPs are from 127.64.0.0/10, so ssh to them fails fast.
+
+Besides the OpenStack APIs, the server answers:
+  GET /_stats     calls per URL template: count, errors, seconds, bytes
+  DELETE /_stats  resets the counters
+  POST /_reset    JSON body with options (i.e. {"servers": 1000}) replaces
+                  the options and regenerates all tenants
+
+$ ./fakeos.py -p 5000 --servers 1000 --latency 0.05
+"""
+
+import argparse
+import BaseHTTPServer
+import calendar
+import hashlib
+import json
+import random
+import re
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import uuid
+
+DEFAULT_PORT = 5000
+
+DEFAULTS = {
+    # generated resources of each tenant
+    'servers': 10,
+    'images': 20,
+    'flavors': 5,
+    'secgroups': 5,
+    'rules': 10,
+    # share of servers with a floating IP, and free floating IPs
+    'floating_ratio': 0.5,
+    'floating_ips': 5,
+    # seconds of delay of each response, and per item in listings
+    'latency': 0.0,
+    'item_latency': 0.0,
+    # share of calls which fail with one of error_codes, only calls with
+    # URL template matching error_path regex if it's set
+    'error_rate': 0.0,
+    'error_codes': [500, 503],
+    'error_path': None,
+    # seconds from create to ACTIVE (fixed IP comes at half), from delete
+    # to gone
+    'build_time': 5.0,
+    'delete_time': 2.0,
+    # most items returned by one Nova listing
+    'max_limit': 1000,
+    # seconds of validity of issued tokens
+    'token_lifetime': 3600,
+    'seed': 0,
+}
+
+FLAVOR_NAMES = ['m1.tiny', 'm1.small', 'm1.medium', 'm1.large', 'm1.xlarge']
+
+FLOATING_POOL = 'public'
+
+UUID_NAMESPACE = uuid.UUID('8c4d5a4e-3f0b-4c0e-9d8e-6c1f4f0a2b7d')
+
+
+def iso_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def parse_time(value):
+    value = value.replace(' ', 'T').rstrip('Z').split('.')[0]
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def tenant_id(name):
+    """Id of fake tenant with given name."""
+    return hashlib.md5(name).hexdigest()
+
+
+def make_id(*parts):
+    return str(uuid.uuid5(UUID_NAMESPACE, '/'.join(str(p) for p in parts)))
+
+
+def floating_address(n):
+    return '127.%d.%d.%d' % (64 + (n >> 16) % 64, (n >> 8) % 256, n % 256)
+
+
+def fixed_address(n):
+    return '10.%d.%d.%d' % ((n >> 16) % 256, (n >> 8) % 256, n % 256 or 1)
+
+
+class FakeError(Exception):
+
+    def __init__(self, code, message, headers=None):
+        Exception.__init__(self, message)
+        self.code = code
+        self.headers = headers or {}
+
+
+class Tenant(object):
+    """Generated resources of one tenant."""
+
+    def __init__(self, name, options):
+        self.name = name
+        self.id = tenant_id(name)
+        self.options = options
+        rnd = random.Random('%s/%s' % (options['seed'], name))
+        now = time.time()
+        self._counter = 0
+
+        self.flavors = [{'id': str(n + 1), 'name': fname, 'ram': 512 << n,
+                         'vcpus': 1 << n, 'disk': 1 << n}
+                        for n, fname in enumerate(
+                            FLAVOR_NAMES[:options['flavors']])]
+
+        self.images = []
+        for n in range(options['images']):
+            img_name = 'ubuntu-14.04' if n == 0 else 'image-%04d' % n
+            self.images.append({'id': make_id(self.id, 'image', n),
+                                'name': img_name, 'created': now - 86400 + n,
+                                'updated': now - 86400 + n})
+
+        self.secgroups = []
+        for n in range(max(1, options['secgroups'])):
+            group = {'id': make_id(self.id, 'secgroup', n),
+                     'name': 'default' if n == 0 else 'secgroup-%d' % n,
+                     'description': 'fake security group %d' % n,
+                     'rules': []}
+            if n == 0:
+                self.add_rule(group, 'tcp', 22, 22, '0.0.0.0/0')
+            for _ in range(options['rules']):
+                port = rnd.randint(1, 60000)
+                self.add_rule(group, 'tcp', port, port + rnd.randint(0, 100),
+                              '%d.%d.0.0/16' % (rnd.randint(1, 223),
+                                                rnd.randint(0, 255)))
+            self.secgroups.append(group)
+
+        self.floating_ips = {}
+        self.servers = {}
+        for n in range(options['servers']):
+            server = self.new_server(
+                'fake-%05d' % n, rnd.choice(self.images)['id'],
+                self.flavors[0]['id'], now - 3600 - n * 10)
+            server['secgroups'] = ['default']
+            if n % 2 and len(self.secgroups) > 1:
+                server['secgroups'].append(rnd.choice(self.secgroups[1:])
+                                           ['name'])
+            if rnd.random() < options['floating_ratio']:
+                fip = self.new_floating_ip()
+                fip['instance_id'] = server['id']
+                server['floating'].append(fip['ip'])
+        for _ in range(options['floating_ips']):
+            self.new_floating_ip()
+
+    def next_number(self):
+        self._counter += 1
+        return self._counter
+
+    def add_rule(self, group, protocol, from_port, to_port, cidr):
+        rule = {'id': make_id(group['id'], 'rule', len(group['rules']),
+                              time.time()),
+                'protocol': protocol, 'from_port': from_port,
+                'to_port': to_port, 'cidr': cidr}
+        group['rules'].append(rule)
+        return rule
+
+    def new_server(self, name, image_id, flavor_id, created):
+        n = self.next_number()
+        server = {'id': make_id(self.id, 'server', n, created), 'name': name,
+                  'image_id': image_id, 'flavor_id': flavor_id,
+                  'created': created, 'touched': created,
+                  'fixed': fixed_address(n), 'floating': [],
+                  'secgroups': ['default'], 'deleted_at': None,
+                  'metadata': {}, 'key_name': None}
+        self.servers[server['id']] = server
+        return server
+
+    def new_floating_ip(self):
+        n = self.next_number()
+        fip = {'id': make_id(self.id, 'fip', n), 'ip': floating_address(n),
+               'instance_id': None}
+        self.floating_ips[fip['id']] = fip
+        return fip
+
+    def server_status(self, server, now):
+        if server['deleted_at'] is not None:
+            return 'DELETED' if now >= server['deleted_at'] else 'ACTIVE'
+        if now - server['created'] < self.options['build_time']:
+            return 'BUILD'
+        return 'ACTIVE'
+
+    def server_updated(self, server, now):
+        """Time of last change of the server, lifecycle changes included."""
+        build = self.options['build_time']
+        events = [server['touched'], server['created'] + build / 2.0,
+                  server['created'] + build]
+        if server['deleted_at'] is not None:
+            events.append(server['deleted_at'])
+        return max(t for t in events if t <= now)
+
+    def secgroup(self, key):
+        for group in self.secgroups:
+            if key in (group['id'], group['name']):
+                return group
+        raise FakeError(404, 'Security group %s not found' % key)
+
+    def server(self, server_id, now):
+        server = self.servers.get(server_id)
+        if server is None or self.server_status(server, now) == 'DELETED':
+            raise FakeError(404, 'Instance %s could not be found' % server_id)
+        return server
+
+
+def paginate(items, query, max_limit):
+    marker = query.get('marker')
+    if marker:
+        ids = [item['id'] for item in items]
+        if marker not in ids:
+            raise FakeError(400, 'marker [%s] not found' % marker)
+        items = items[ids.index(marker) + 1:]
+    limit = int(query.get('limit') or max_limit)
+    return items[:min(limit, max_limit)]
+
+
+class FakeCloud(object):
+    """State of the fake cloud: tenants, tokens and call statistics."""
+
+    def __init__(self, options=None):
+        self.lock = threading.RLock()
+        self.url = None
+        self.tokens = {}
+        self.stats = {}
+        self.reset(options)
+
+    def reset(self, options=None):
+        with self.lock:
+            self.options = dict(DEFAULTS, **(options or {}))
+            self.tenants = {}
+
+    def tenant(self, name):
+        with self.lock:
+            if name not in self.tenants:
+                self.tenants[name] = Tenant(name, self.options)
+            return self.tenants[name]
+
+    def authorized_tenant(self, token):
+        with self.lock:
+            tenant_name, expires = self.tokens.get(token, (None, 0))
+            if tenant_name is None or expires < time.time():
+                raise FakeError(401, 'The request you have made requires '
+                                'authentication.')
+            return self.tenant(tenant_name)
+
+    def record(self, template, status, seconds, size):
+        with self.lock:
+            s = self.stats.setdefault(template, {'count': 0, 'errors': 0,
+                                                 'seconds': 0.0, 'bytes': 0})
+            s['count'] += 1
+            s['errors'] += status >= 400
+            s['seconds'] += seconds
+            s['bytes'] += size
+
+    # Keystone
+
+    def keystone_tokens(self, body, **_):
+        auth = body.get('auth', {})
+        tenant_name = auth.get('tenantName')
+        if not tenant_name or 'passwordCredentials' not in auth and \
+                'token' not in auth:
+            raise FakeError(401, 'Invalid credentials')
+        tenant = self.tenant(tenant_name)
+        token = uuid.uuid4().hex
+        now = time.time()
+        expires = now + self.options['token_lifetime']
+        with self.lock:
+            self.tokens[token] = (tenant_name, expires)
+        username = auth.get('passwordCredentials', {}).get('username', 'fake')
+
+        def service(stype, name, url):
+            return {'type': stype, 'name': name, 'endpoints_links': [],
+                    'endpoints': [{'region': 'RegionOne', 'id': name,
+                                   'publicURL': url, 'internalURL': url,
+                                   'adminURL': url}]}
+        return 200, {'access': {
+            'token': {'id': token, 'issued_at': iso_time(now),
+                      'expires': iso_time(expires),
+                      'tenant': {'id': tenant.id, 'name': tenant.name,
+                                 'enabled': True, 'description': None}},
+            'serviceCatalog': [
+                service('compute', 'nova', '%s/v2/%s' % (self.url,
+                                                         tenant.id)),
+                service('image', 'glance', self.url),
+                service('network', 'neutron', self.url),
+                service('identity', 'keystone', self.url + '/v2.0')],
+            'user': {'id': make_id('user', username), 'name': username,
+                     'username': username, 'roles_links': [],
+                     'roles': [{'name': '_member_'}]},
+            'metadata': {'is_admin': 0, 'roles': []}}}
+
+    def keystone_version(self, **_):
+        return 200, {'version': {'id': 'v2.0', 'status': 'stable',
+                                 'links': [{'rel': 'self',
+                                            'href': self.url + '/v2.0/'}]}}
+
+    # Nova
+
+    def _nova_server(self, tenant, server, now):
+        addresses = []
+        if now - server['created'] >= self.options['build_time'] / 2.0:
+            addresses.append({'addr': server['fixed'], 'version': 4,
+                              'OS-EXT-IPS:type': 'fixed'})
+        addresses += [{'addr': ip, 'version': 4, 'OS-EXT-IPS:type': 'floating'}
+                      for ip in server['floating']]
+        status = tenant.server_status(server, now)
+        return {'id': server['id'], 'name': server['name'], 'status': status,
+                'tenant_id': tenant.id, 'user_id': 'fake',
+                'image': {'id': server['image_id'], 'links': []},
+                'flavor': {'id': server['flavor_id'], 'links': []},
+                'addresses': {'private': addresses} if addresses else {},
+                'security_groups': [{'name': n} for n in server['secgroups']],
+                'created': iso_time(server['created']),
+                'updated': iso_time(tenant.server_updated(server, now)),
+                'metadata': server['metadata'],
+                'key_name': server['key_name'],
+                'OS-EXT-STS:vm_state': status.lower(),
+                'OS-EXT-STS:task_state': 'deleting' if (
+                    server['deleted_at'] and status != 'DELETED') else None,
+                'links': []}
+
+    def nova_servers(self, tenant, query, **_):
+        now = time.time()
+        with self.lock:
+            servers = sorted(tenant.servers.values(),
+                             key=lambda s: (-s['created'], s['id']))
+            if 'changes-since' in query:
+                since = parse_time(query['changes-since'])
+                servers = [s for s in servers
+                           if tenant.server_updated(s, now) >= since]
+            else:
+                servers = [s for s in servers
+                           if tenant.server_status(s, now) != 'DELETED']
+            if query.get('name'):
+                name_re = re.compile(query['name'])
+                servers = [s for s in servers if name_re.search(s['name'])]
+            if query.get('status'):
+                servers = [s for s in servers if tenant.server_status(
+                    s, now) == query['status'].upper()]
+            servers = paginate(servers, query, self.options['max_limit'])
+            return 200, {'servers': [self._nova_server(tenant, s, now)
+                                     for s in servers]}
+
+    def nova_server(self, tenant, match, **_):
+        now = time.time()
+        with self.lock:
+            server = tenant.server(match.group('id'), now)
+            return 200, {'server': self._nova_server(tenant, server, now)}
+
+    def nova_create_server(self, tenant, body, **_):
+        params = body.get('server', {})
+        if not params.get('name'):
+            raise FakeError(400, 'Server name is not defined')
+        now = time.time()
+        with self.lock:
+            if params.get('imageRef') not in [img['id'] for img
+                                              in tenant.images]:
+                raise FakeError(400, 'Can not find requested image')
+            server = tenant.new_server(params['name'], params['imageRef'],
+                                       params.get('flavorRef'), now)
+            server['metadata'] = params.get('metadata') or {}
+            server['key_name'] = params.get('key_name')
+            server['secgroups'] = [g['name'] for g in
+                                   params.get('security_groups') or []] or [
+                                       'default']
+            view = self._nova_server(tenant, server, now)
+        view['adminPass'] = 'fake'
+        return 202, {'server': view}
+
+    def nova_delete_server(self, tenant, match, **_):
+        now = time.time()
+        with self.lock:
+            server = tenant.server(match.group('id'), now)
+            if server['deleted_at'] is None:
+                server['deleted_at'] = now + self.options['delete_time']
+                server['touched'] = now
+                for fip in tenant.floating_ips.values():
+                    if fip['instance_id'] == server['id']:
+                        fip['instance_id'] = None
+        return 204, None
+
+    def nova_server_action(self, tenant, match, body, **_):
+        now = time.time()
+        with self.lock:
+            server = tenant.server(match.group('id'), now)
+            if 'addFloatingIp' in body:
+                address = body['addFloatingIp'].get('address')
+                fips = [f for f in tenant.floating_ips.values()
+                        if f['ip'] == address]
+                if not fips:
+                    raise FakeError(404, 'floating ip not found')
+                if now - server['created'] < self.options['build_time'] / 2.0:
+                    raise FakeError(400, 'No nw_info cache associated with '
+                                    'instance')
+                fips[0]['instance_id'] = server['id']
+                server['floating'].append(address)
+            elif 'removeFloatingIp' in body:
+                address = body['removeFloatingIp'].get('address')
+                for f in tenant.floating_ips.values():
+                    if f['ip'] == address:
+                        f['instance_id'] = None
+                if address in server['floating']:
+                    server['floating'].remove(address)
+            else:
+                raise FakeError(400, 'Unsupported action %s' % body.keys())
+            server['touched'] = now
+        return 202, None
+
+    def nova_flavors(self, tenant, **_):
+        return 200, {'flavors': [dict(f, links=[]) for f in tenant.flavors]}
+
+    def nova_flavor(self, tenant, match, **_):
+        for f in tenant.flavors:
+            if f['id'] == match.group('id'):
+                return 200, {'flavor': dict(f, links=[])}
+        raise FakeError(404, 'Flavor %s could not be found' % match.group('id'))
+
+    def _nova_image(self, img):
+        return {'id': img['id'], 'name': img['name'], 'status': 'ACTIVE',
+                'minDisk': 0, 'minRam': 0, 'progress': 100, 'metadata': {},
+                'created': iso_time(img['created']),
+                'updated': iso_time(img['updated']), 'links': []}
+
+    def nova_images(self, tenant, query, **_):
+        images = paginate(tenant.images, query, self.options['max_limit'])
+        return 200, {'images': [self._nova_image(img) for img in images]}
+
+    def nova_image(self, tenant, match, **_):
+        for img in tenant.images:
+            if img['id'] == match.group('id'):
+                return 200, {'image': self._nova_image(img)}
+        raise FakeError(404, 'Image not found.')
+
+    def nova_limits(self, tenant, **_):
+        now = time.time()
+        with self.lock:
+            used = len([s for s in tenant.servers.values()
+                        if tenant.server_status(s, now) != 'DELETED'])
+        return 200, {'limits': {'rate': [], 'absolute': {
+            'maxTotalInstances': 100000, 'totalInstancesUsed': used,
+            'maxSecurityGroups': 1000,
+            'totalSecurityGroupsUsed': len(tenant.secgroups),
+            'maxTotalFloatingIps': 100000,
+            'totalFloatingIpsUsed': len(tenant.floating_ips)}}}
+
+    def _nova_fip(self, tenant, fip):
+        server = tenant.servers.get(fip['instance_id'])
+        return {'id': fip['id'], 'ip': fip['ip'], 'pool': FLOATING_POOL,
+                'instance_id': fip['instance_id'],
+                'fixed_ip': server['fixed'] if server else None}
+
+    def nova_floating_ips(self, tenant, **_):
+        with self.lock:
+            return 200, {'floating_ips': [self._nova_fip(tenant, f) for f in
+                                          tenant.floating_ips.values()]}
+
+    def nova_create_floating_ip(self, tenant, body, **_):
+        with self.lock:
+            fip = tenant.new_floating_ip()
+            return 200, {'floating_ip': self._nova_fip(tenant, fip)}
+
+    def nova_delete_floating_ip(self, tenant, match, **_):
+        with self.lock:
+            fip = tenant.floating_ips.pop(match.group('id'), None)
+            if fip is None:
+                raise FakeError(404, 'Floating ip not found')
+            server = tenant.servers.get(fip['instance_id'])
+            if server and fip['ip'] in server['floating']:
+                server['floating'].remove(fip['ip'])
+        return 202, None
+
+    def nova_floating_ip_pools(self, **_):
+        return 200, {'floating_ip_pools': [{'name': FLOATING_POOL}]}
+
+    def _nova_secgroup(self, tenant, group):
+        return {'id': group['id'], 'name': group['name'],
+                'description': group['description'], 'tenant_id': tenant.id,
+                'rules': [self._nova_rule(group, r) for r in group['rules']]}
+
+    def _nova_rule(self, group, rule):
+        return {'id': rule['id'], 'parent_group_id': group['id'],
+                'ip_protocol': rule['protocol'],
+                'from_port': rule['from_port'], 'to_port': rule['to_port'],
+                'ip_range': {'cidr': rule['cidr']} if rule['cidr'] else {},
+                'group': {}}
+
+    def nova_secgroups(self, tenant, **_):
+        with self.lock:
+            return 200, {'security_groups': [
+                self._nova_secgroup(tenant, g) for g in tenant.secgroups]}
+
+    def nova_secgroup(self, tenant, match, **_):
+        with self.lock:
+            return 200, {'security_group': self._nova_secgroup(
+                tenant, tenant.secgroup(match.group('id')))}
+
+    def nova_create_secgroup(self, tenant, body, **_):
+        params = body.get('security_group', {})
+        with self.lock:
+            group = {'id': str(uuid.uuid4()), 'name': params.get('name'),
+                     'description': params.get('description'), 'rules': []}
+            tenant.secgroups.append(group)
+            return 200, {'security_group': self._nova_secgroup(tenant, group)}
+
+    def nova_create_rule(self, tenant, body, **_):
+        params = body.get('security_group_rule', {})
+        with self.lock:
+            group = tenant.secgroup(params.get('parent_group_id'))
+            for r in group['rules']:
+                if (r['protocol'], r['from_port'], r['to_port'], r['cidr']) \
+                        == (params.get('ip_protocol'),
+                            int(params.get('from_port')),
+                            int(params.get('to_port')), params.get('cidr')):
+                    raise FakeError(400, 'This rule already exists in group '
+                                    '%s' % group['id'])
+            rule = tenant.add_rule(group, params.get('ip_protocol'),
+                                   int(params.get('from_port')),
+                                   int(params.get('to_port')),
+                                   params.get('cidr'))
+            return 200, {'security_group_rule': self._nova_rule(group, rule)}
+
+    def nova_delete_rule(self, tenant, match, **_):
+        with self.lock:
+            for group in tenant.secgroups:
+                for rule in group['rules']:
+                    if rule['id'] == match.group('id'):
+                        group['rules'].remove(rule)
+                        return 202, None
+        raise FakeError(404, 'Rule not found')
+
+    # Glance
+
+    def _glance_image(self, tenant, img):
+        return {'id': img['id'], 'name': img['name'], 'status': 'active',
+                'is_public': True, 'deleted': False, 'deleted_at': None,
+                'protected': False, 'size': 256 << 20, 'checksum': None,
+                'disk_format': 'qcow2', 'container_format': 'bare',
+                'min_disk': 0, 'min_ram': 0, 'owner': tenant.id,
+                'created_at': iso_time(img['created']).rstrip('Z'),
+                'updated_at': iso_time(img['updated']).rstrip('Z'),
+                'properties': {}}
+
+    def glance_images(self, tenant, query, **_):
+        images = tenant.images
+        if 'changes-since' in query:
+            since = parse_time(query['changes-since'])
+            images = [img for img in images if img['updated'] >= since]
+        if query.get('name'):
+            images = [img for img in images if img['name'] == query['name']]
+        images = paginate(images, query, self.options['max_limit'])
+        return 200, {'images': [self._glance_image(tenant, img)
+                                for img in images]}
+
+    def glance_image_head(self, tenant, match, **_):
+        for img in tenant.images:
+            if img['id'] == match.group('id'):
+                view = self._glance_image(tenant, img)
+                headers = dict(('x-image-meta-%s' % k.replace('_', '-'),
+                                str(v)) for k, v in view.items()
+                               if k != 'properties' and v is not None)
+                return 200, None, headers
+        raise FakeError(404, 'Image not found.')
+
+    # Neutron
+
+    def _neutron_secgroup(self, tenant, group):
+        rules = [{'id': r['id'], 'security_group_id': group['id'],
+                  'tenant_id': tenant.id, 'direction': 'ingress',
+                  'ethertype': 'IPv4', 'protocol': r['protocol'],
+                  'port_range_min': r['from_port'],
+                  'port_range_max': r['to_port'],
+                  'remote_ip_prefix': r['cidr'], 'remote_group_id': None}
+                 for r in group['rules']]
+        return {'id': group['id'], 'name': group['name'],
+                'description': group['description'], 'tenant_id': tenant.id,
+                'security_group_rules': rules}
+
+    def neutron_secgroups(self, tenant, **_):
+        with self.lock:
+            return 200, {'security_groups': [
+                self._neutron_secgroup(tenant, g) for g in tenant.secgroups]}
+
+    def _neutron_port(self, tenant, server):
+        return {'id': make_id(server['id'], 'port'),
+                'device_id': server['id'], 'device_owner': 'compute:nova',
+                'tenant_id': tenant.id, 'status': 'ACTIVE',
+                'fixed_ips': [{'ip_address': server['fixed']}],
+                'security_groups': [tenant.secgroup(n)['id']
+                                    for n in server['secgroups']]}
+
+    def neutron_ports(self, tenant, query, **_):
+        now = time.time()
+        with self.lock:
+            servers = [s for s in tenant.servers.values()
+                       if tenant.server_status(s, now) != 'DELETED']
+            if query.get('device_id'):
+                servers = [s for s in servers
+                           if s['id'] == query['device_id']]
+            return 200, {'ports': [self._neutron_port(tenant, s)
+                                   for s in servers]}
+
+    def neutron_update_port(self, tenant, match, body, **_):
+        with self.lock:
+            for server in tenant.servers.values():
+                if make_id(server['id'], 'port') == match.group('id'):
+                    groups = body.get('port', {}).get('security_groups')
+                    if groups is not None:
+                        server['secgroups'] = [tenant.secgroup(g)['name']
+                                               for g in groups]
+                        server['touched'] = time.time()
+                    return 200, {'port': self._neutron_port(tenant, server)}
+        raise FakeError(404, 'Port %s could not be found' % match.group('id'))
+
+    # control of the fake
+
+    def get_stats(self, **_):
+        with self.lock:
+            return 200, {'calls': self.stats,
+                         'total': sum(s['count'] for s in
+                                      self.stats.values())}
+
+    def reset_stats(self, **_):
+        with self.lock:
+            self.stats = {}
+        return 204, None
+
+    def post_reset(self, body, **_):
+        self.reset(body)
+        return 200, {'options': self.options}
+
+
+NOVA = r'^/v(?:1\.1|2)/(?P<tenant_id>[^/]+)'
+ID = r'(?P<id>[^/]+?)'
+JSON = r'(?:\.json)?'
+
+# (method, path regex, URL template for statistics, FakeCloud method,
+#  how the tenant is found: "token", "nova" or None)
+ROUTES = [
+    ('POST', r'^/v2\.0/tokens$', 'keystone POST /v2.0/tokens',
+     'keystone_tokens', None),
+    ('GET', r'^/v2\.0/?$', 'keystone GET /v2.0', 'keystone_version', None),
+    ('GET', NOVA + r'/servers(?:/detail)?$', 'nova GET /servers/detail',
+     'nova_servers', 'nova'),
+    ('POST', NOVA + r'/servers$', 'nova POST /servers',
+     'nova_create_server', 'nova'),
+    ('GET', NOVA + r'/servers/' + ID + '$', 'nova GET /servers/{id}',
+     'nova_server', 'nova'),
+    ('DELETE', NOVA + r'/servers/' + ID + '$', 'nova DELETE /servers/{id}',
+     'nova_delete_server', 'nova'),
+    ('POST', NOVA + r'/servers/' + ID + '/action$',
+     'nova POST /servers/{id}/action', 'nova_server_action', 'nova'),
+    ('GET', NOVA + r'/flavors(?:/detail)?$', 'nova GET /flavors/detail',
+     'nova_flavors', 'nova'),
+    ('GET', NOVA + r'/flavors/' + ID + '$', 'nova GET /flavors/{id}',
+     'nova_flavor', 'nova'),
+    ('GET', NOVA + r'/images(?:/detail)?$', 'nova GET /images/detail',
+     'nova_images', 'nova'),
+    ('GET', NOVA + r'/images/' + ID + '$', 'nova GET /images/{id}',
+     'nova_image', 'nova'),
+    ('GET', NOVA + r'/limits$', 'nova GET /limits', 'nova_limits', 'nova'),
+    ('GET', NOVA + r'/os-floating-ips$', 'nova GET /os-floating-ips',
+     'nova_floating_ips', 'nova'),
+    ('POST', NOVA + r'/os-floating-ips$', 'nova POST /os-floating-ips',
+     'nova_create_floating_ip', 'nova'),
+    ('DELETE', NOVA + r'/os-floating-ips/' + ID + '$',
+     'nova DELETE /os-floating-ips/{id}', 'nova_delete_floating_ip', 'nova'),
+    ('GET', NOVA + r'/os-floating-ip-pools$',
+     'nova GET /os-floating-ip-pools', 'nova_floating_ip_pools', 'nova'),
+    ('GET', NOVA + r'/os-security-groups$', 'nova GET /os-security-groups',
+     'nova_secgroups', 'nova'),
+    ('GET', NOVA + r'/os-security-groups/' + ID + '$',
+     'nova GET /os-security-groups/{id}', 'nova_secgroup', 'nova'),
+    ('POST', NOVA + r'/os-security-groups$',
+     'nova POST /os-security-groups', 'nova_create_secgroup', 'nova'),
+    ('POST', NOVA + r'/os-security-group-rules$',
+     'nova POST /os-security-group-rules', 'nova_create_rule', 'nova'),
+    ('DELETE', NOVA + r'/os-security-group-rules/' + ID + '$',
+     'nova DELETE /os-security-group-rules/{id}', 'nova_delete_rule', 'nova'),
+    ('GET', r'^/v1/images(?:/detail)?$', 'glance GET /v1/images/detail',
+     'glance_images', 'token'),
+    ('HEAD', r'^/v1/images/' + ID + '$', 'glance HEAD /v1/images/{id}',
+     'glance_image_head', 'token'),
+    ('GET', r'^/v2\.0/security-groups' + JSON + '$',
+     'neutron GET /v2.0/security-groups', 'neutron_secgroups', 'token'),
+    ('GET', r'^/v2\.0/ports' + JSON + '$', 'neutron GET /v2.0/ports',
+     'neutron_ports', 'token'),
+    ('PUT', r'^/v2\.0/ports/' + ID + JSON + '$',
+     'neutron PUT /v2.0/ports/{id}', 'neutron_update_port', 'token'),
+    ('GET', r'^/_stats$', None, 'get_stats', None),
+    ('DELETE', r'^/_stats$', None, 'reset_stats', None),
+    ('POST', r'^/_reset$', None, 'post_reset', None),
+]
+
+ROUTES = [(method, re.compile(regex), template, func, tenant_from)
+          for method, regex, template, func, tenant_from in ROUTES]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    verbose = False
+
+    def log_message(self, fmt, *args):
+        if self.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def _route(self, path):
+        allowed = False
+        for method, regex, template, func, tenant_from in ROUTES:
+            match = regex.match(path)
+            if match is None:
+                continue
+            allowed = True
+            if method == self.command:
+                return match, template, func, tenant_from
+        if allowed:
+            raise FakeError(405, 'Method %s not allowed' % self.command)
+        raise FakeError(404, 'No fake for %s %s' % (self.command, path))
+
+    def _tenant(self, cloud, match, tenant_from):
+        if tenant_from is None:
+            return None
+        tenant = cloud.authorized_tenant(self.headers.get('X-Auth-Token'))
+        if tenant_from == 'nova' and match.group('tenant_id') not in (
+                tenant.id, tenant.name):
+            raise FakeError(403, 'Token is not valid for tenant %s'
+                            % match.group('tenant_id'))
+        return tenant
+
+    def _inject_error(self, cloud, template):
+        options = cloud.options
+        if template is None or random.random() >= options['error_rate']:
+            return
+        if options['error_path'] and not re.search(options['error_path'],
+                                                   template):
+            return
+        code = random.choice(options['error_codes'])
+        headers = {'Retry-After': '1'} if code in (413, 429) else {}
+        raise FakeError(code, 'Injected error', headers)
+
+    def _handle(self):
+        cloud = self.server.cloud
+        start = time.time()
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else ''
+        template = None
+        headers = {}
+        try:
+            match, template, func, tenant_from = self._route(url.path)
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                raise FakeError(400, 'Malformed request body')
+            self._inject_error(cloud, template)
+            tenant = self._tenant(cloud, match, tenant_from)
+            result = getattr(cloud, func)(tenant=tenant, match=match,
+                                          query=query, body=body)
+            status, payload = result[:2]
+            if len(result) > 2:
+                headers = result[2]
+        except FakeError as e:
+            status, headers = e.code, e.headers
+            payload = {'error': {'code': e.code, 'message': str(e)}}
+        data = json.dumps(payload) if payload is not None else ''
+        if template is not None:
+            delay = cloud.options['latency']
+            if isinstance(payload, dict):
+                items = sum(len(v) for v in payload.values()
+                            if isinstance(v, list))
+                delay += items * cloud.options['item_latency']
+            time.sleep(max(0, delay - (time.time() - start)))
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+        if template is not None:
+            cloud.record(template, status, time.time() - start, len(data))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cloud):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.cloud = cloud
+        cloud.url = 'http://%s:%d' % self.server_address
+
+
+def start(options=None, port=0, host='127.0.0.1'):
+    """Starts fake cloud in a background thread, returns the FakeServer.
+    Its URL is in server.cloud.url."""
+    server = FakeServer((host, port), FakeCloud(options))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Fake OpenStack API for local runs and benchmarks')
+
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-t', '--tenant', default='fake',
+                        help='tenant name to print the environment for')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every request')
+    for key, value in sorted(DEFAULTS.items()):
+        kwargs = {'default': value}
+        if isinstance(value, list):
+            kwargs.update(nargs='+', type=type(value[0]))
+        elif value is not None:
+            kwargs['type'] = type(value)
+        parser.add_argument('--' + key.replace('_', '-'), **kwargs)
+
+    return parser.parse_args(args_list)
+
+
+def main(args_list):
+    args = get_args(args_list)
+    options = dict((key, getattr(args, key)) for key in DEFAULTS)
+    Handler.verbose = args.verbose
+    server = FakeServer((args.host, args.port), FakeCloud(options))
+    print "export OS_AUTH_URL=%s/v2.0" % server.cloud.url
+    print "export OS_TENANT_NAME=%s" % args.tenant
+    print "export OS_TENANT_ID=%s" % tenant_id(args.tenant)
+    print "export OS_USERNAME=fake OS_PASSWORD=fake"
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
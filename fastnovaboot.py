@@ -6,6 +6,17 @@ to it.
 
 It also checks the status of the machine shortly after creation.
 
+The boot is pipelined: image, flavor and security groups are resolved
+concurrently, a floating IP is reserved while the server is building, and
+only the steps which need the server's port wait for it.
+
+Floating IPs are taken from the warm pool kept by fippool.py when it has
+some, without listing the floating IPs of the tenant.
+
+With --count N, N servers with the same parameters are booted concurrently
+(see --concurrency) and a tab-separated table of their ids and IPs is printed
+to stdout.
+
 See the util.py first, and set the BASE_* variables to what you like
 
 The script takes credentials, tenant name and Keystone URL from the usual
@@ -23,8 +34,14 @@ import json
 import socket
 import sys
 import os
+import threading
+from multiprocessing.pool import ThreadPool
 
+import fippool
+import namecache
+import secrules
 import util
+import waiter
 
 
 def is_valid_ipv4_address(address):
@@ -50,58 +67,18 @@ _nova = util.NovaProxy
 _glance = util.GlanceProxy
 _neutron = util.NeutronProxy
 
+# how many servers are created at once in batch mode (--count)
+CONCURRENCY = 10
 
-def get_free_floating_ips():
-    return [ ip for ip in _nova().floating_ips.list()
-             if ip.instance_id is None ]
 
-def get_free_floating_ip(ip):
-    for ii in get_free_floating_ips():
-        if ii.ip == ip:
-            return ii
-    raise util.NovaWrapperError("No free floating ip %s found" % ip)
+get_free_floating_ips = fippool.get_free_floating_ips
+get_floating_ip_pool_name = fippool.get_floating_ip_pool_name
+allocate_floating_ip = fippool.allocate_floating_ip
 
 
-def allocate_floating_ip():
-    pool_name = _nova().floating_ip_pools.list()[0].name
-    i("Found pool %s, will try to allocate one floating IP from it"
-      % pool_name)
-    try:
-        _nova().floating_ips.create(pool=pool_name)
-    except Exception as e:
-        # TODO: check what exception this throws
-        util.logger.error("Most likely no more IPs in the pool %s"
-                           % pool_name)
-        raise e
-
 def dig_a_floating_ip():
-    free_ips = get_free_floating_ips()
-    if len(free_ips) == 0:
-        i("There are no free allocated floating IPs. The script will attempt "
-          "to get one from the first available pool.")
-        allocate_floating_ip()
-        free_ips = get_free_floating_ips()
-        i("A floating IP was allocated from the pool")
-    return free_ips[0]
-
-
-def find_server_with_id(server_id):
-    found = [ s for s in _nova().servers.list() if s.id == server_id ]
-    if not found:
-        raise util.NovaWrapperError("No server with id %s" % server_id)
-    return found[0]
-
-
-def server_has_a_fixed_ip(server_id):
-    server = find_server_with_id(server_id)
-    attached_nets = server.networks
-    if not attached_nets:
-        return False
-    for net in attached_nets.values():
-        if len(net) > 0:
-            i("Server %s has fixed IP %s" % (server_id, net))
-            return True
-    return False
+    """Returns Lease of a free floating IP, allocating one if needed."""
+    return fippool.lease(1)[0]
 
 
 def add_security_groups(server_id, secgroup_ids):
@@ -113,35 +90,130 @@ def add_security_groups(server_id, secgroup_ids):
         _neutron().update_port(port['id'], body={'port': {'security_groups':secgroup_ids}})
 
 
-def find_resource_id_by_name(name, resource_list, use_getitem=False,
-                             subitem=None):
+find_resource_id_by_name = util.find_resource_id_by_name
+
+
+def list_images():
+    return [(img.id, img.name) for img in _glance().images.list()]
+
+
+def list_flavors():
+    return [(f.id, f.name) for f in _nova().flavors.list()]
+
+
+def list_secgroups():
+    return [(sg['id'], sg['name']) for sg in _neutron().list_security_groups(
+                tenant_id=os.environ['OS_TENANT_ID'])['security_groups']]
+
+
+def resolve_image(name):
+    return namecache.resolve('image', name, list_images)
+
+
+def resolve_flavor(name):
+    return namecache.resolve('flavor', name, list_flavors)
+
+
+def resolve_secgroups(names):
+    return [namecache.resolve('secgroup', sg, list_secgroups)
+            for sg in names.split(',')]
+
+
+def warn_if_ssh_closed(secgroup_ids):
+    """Logs a warning if none of the security groups opens port 22."""
     try:
-        uuid.UUID(name)
-        # name is uuid
-        return name
-    except ValueError:
-        if subitem:
-            resource_list = resource_list[subitem]
-        if use_getitem:
-            matching = [r['id'] for r in resource_list if name == r['name']]
-        else:
-            matching = [r.id for r in resource_list if name == r.name]
-        if len(matching) == 0:
-            msg = ("Could not find any resource matching name '%s'. "
-                   "If this is an image, check that it's public or shared "
-                   "with the current tenant (it's listed in $ glance index)"
-                   % name)
-            raise util.NovaWrapperError(msg)
-        if len(matching) > 1:
-            raise util.NovaWrapperError(
-                "Found too many resources matching name '%s': %s" %
-                (name, matching))
-        return matching[0]
+        index = secrules.load()
+        if not index.reachable(secgroup_ids, 22):
+            util.logger.warning("Port 22 is not open in any of the security "
+                                "groups %s, ssh to the server won't work"
+                                % secgroup_ids)
+    except Exception as e:
+        d("Checking security group rules failed: %s" % e)
 
 
-def get_args(args_list):
-    _name = util.BASE_NAME + '-' + uuid.uuid4().hex[:4]
+def reserve_floating_ip(ip=None):
+    """Returns Lease of free allocated floating IP, allocating it if
+    necessary.
+
+    If ip is given, leases the floating IP with that address, and raises
+    util.NovaWrapperError if it's not free. Otherwise the floating IP is
+    claimed from the warm pool if possible.
+    """
+    if ip is None:
+        lease = dig_a_floating_ip()
+        d("Leased floating IP %s" % lease.ip)
+        return lease
+    i("Checking if ip %s is available" % ip)
+    return fippool.lease_ip(ip)
+
+
+def assign_floating_ip(server, floating_ip, another=True):
+    """Assigns floating IP to server. If the floating IP was leased (see
+    fippool.lease) and can't be assigned (someone else took it), assigns
+    another one, unless another is False.
+
+    Returns the assigned floating IP.
+    """
+    try:
+        server.add_floating_ip(floating_ip)
+    except Exception as e:
+        if not another or not isinstance(floating_ip, fippool.Lease):
+            raise
+        util.logger.warning("Leased floating IP %s can't be assigned (%s), "
+                            "trying another one" % (floating_ip.ip, e))
+        fippool.done(floating_ip.ip, used=False)
+        floating_ip = dig_a_floating_ip()
+        try:
+            server.add_floating_ip(floating_ip)
+        except Exception:
+            release_floating_ip(floating_ip)
+            raise
+    fippool.done(floating_ip.ip)
+    return floating_ip
+
+
+def release_floating_ip(floating_ip):
+    """Gives back leased floating IP which won't be assigned."""
+    if isinstance(floating_ip, fippool.Lease):
+        fippool.release([floating_ip])
+
+
+class FreeFloatingIPs(object):
+    """Free floating IPs leased once (see fippool.lease), then handed out
+    to concurrent boots of a batch."""
+
+    def __init__(self, needed):
+        self._lock = threading.Lock()
+        self._free = fippool.lease(needed)
+
+    def claim(self):
+        with self._lock:
+            if not self._free:
+                raise util.NovaWrapperError("No free floating IP left")
+            return self._free.pop(0)
+
+    def release_unused(self):
+        """Gives back the leases which weren't handed out."""
+        with self._lock:
+            unused, self._free = self._free, []
+        fippool.release(unused)
 
+
+def random_name():
+    return util.BASE_NAME + '-' + uuid.uuid4().hex[:4]
+
+
+def batch_names(name, count):
+    """Names of servers in a batch, name-1 .. name-N if name is given."""
+    if name is not None:
+        return ['%s-%d' % (name, n) for n in range(1, count + 1)]
+    names = set()
+    while len(names) < count:
+        names.add(random_name())
+    return sorted(names)
+
+
+def get_args(args_list):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         prog='fastnovaboot',
@@ -166,8 +238,11 @@ def get_args(args_list):
     help_floatingip = ("Floating IP or FQDN of a floating IP to assign after "
                        "server boot. Not mandatory - if you don't supply, the "
                        "script will try to find a free floating ip.")
+    help_count = ("number of servers to boot. With more than one, servers "
+                  "are named <name>-1 .. <name>-N if --name is given.")
+    help_concurrency = "how many servers to create at once with --count"
 
-    parser.add_argument('-n', '--name', help=help_name, default=_name)
+    parser.add_argument('-n', '--name', help=help_name)
     parser.add_argument('-i', '--image', help=help_image,
                         default=util.BASE_IMAGE)
     parser.add_argument('-f', '--flavor', help=help_flavor,
@@ -181,22 +256,43 @@ def get_args(args_list):
     parser.add_argument('-s', '--secgroups', help=help_secgroups,
                         required=True)
     parser.add_argument('-m', '--meta', help=help_meta)
+    parser.add_argument('-c', '--count', help=help_count, type=int,
+                        default=1)
+    parser.add_argument('-j', '--concurrency', help=help_concurrency,
+                        type=int, default=CONCURRENCY)
+    util.add_profile_args(parser)
 
     return parser.parse_args(args_list)
 
 
 def main(args_list):
     args = get_args(args_list)
+    util.setup_profile(args)
+    util.share_http_pool(args.concurrency)
+    start = time.time()
 
-    _image  = find_resource_id_by_name(args.image, _glance().images.list())
-    _flavor = find_resource_id_by_name(args.flavor, _nova().flavors.list())
+    if args.count > 1:
+        if args.floatingip:
+            raise util.NovaWrapperError("--floatingip can't be used with "
+                                        "--count")
+        pool = ThreadPool(max(3, args.concurrency))
+        boot = _boot_batch
+    else:
+        if args.name is None:
+            args.name = random_name()
+        pool = ThreadPool(3)
+        boot = _boot
+    try:
+        return boot(args, pool, start)
+    finally:
+        pool.close()
+        pool.join()
 
-    if args.test:
-        print "args are"
-        print args
 
-    params = {'name': args.name, 'image': _image, 'flavor': _flavor,
-              'key_name': util.KEYPAIR, 'userdata': args.userdata}
+def make_params(args, image, flavor):
+    """Parameters of servers.create common to all servers of a boot."""
+    params = {'image': image, 'flavor': flavor, 'key_name': util.KEYPAIR,
+              'userdata': args.userdata.read() if args.userdata else None}
 
     if args.meta:
         _meta_dict = json.loads(args.meta)
@@ -207,6 +303,142 @@ def main(args_list):
             raise util.NovaWrapperError("the meta dict can't have more than 5"
                                        " items")
         params['meta'] = _meta_dict
+    return params
+
+
+def delete_servers(servers):
+    for s in servers:
+        i("Deleting half-created server %s" % s.id)
+        try:
+            _nova().servers.delete(s.id)
+        except Exception as e:
+            util.logger.error("Deleting server %s failed: %s" % (s.id, e))
+
+
+def _setup_server(server, floating_ips, secgroup_ids):
+    floating_ip = floating_ips.claim()
+    try:
+        i("Assigning floating IP %s to server %s"
+          % (floating_ip.ip, server.id))
+        floating_ip = assign_floating_ip(server, floating_ip)
+        add_security_groups(server.id, secgroup_ids)
+    except Exception:
+        release_floating_ip(floating_ip)
+        delete_servers([server])
+        raise
+    return floating_ip.ip
+
+
+def _abort_batch(created, floating_ips_r):
+    """Deletes the created servers and gives back the floating IP leases of
+    a failed batch."""
+    delete_servers(created)
+    floating_ips_r.wait()
+    if floating_ips_r.successful():
+        floating_ips_r.get().release_unused()
+
+
+def _boot_batch(args, pool, start):
+    image_r = pool.apply_async(resolve_image, (args.image,))
+    flavor_r = pool.apply_async(resolve_flavor, (args.flavor,))
+    secgroups_r = pool.apply_async(resolve_secgroups, (args.secgroups,))
+
+    with util.phase('resolve'):
+        image = image_r.get()
+        params = make_params(args, image, flavor_r.get())
+        names = batch_names(args.name, args.count)
+        secgroup_ids = secgroups_r.get()
+    pool.apply_async(warn_if_ssh_closed, (secgroup_ids,))
+
+    i("Launching %d servers %s with parameters:\n%s" %
+      (args.count, names, pprint.pformat(params)))
+
+    if args.test:
+        i("This is a test run, _NOT_ booting the instances.")
+        return (image, [])
+
+    floating_ips_r = pool.apply_async(FreeFloatingIPs, (args.count,))
+    creates = [pool.apply_async(_nova().servers.create, (),
+                                dict(params, name=name))
+               for name in names]
+    with util.phase('create'):
+        created, failed = [], []
+        for c in creates:
+            try:
+                created.append(c.get())
+            except Exception as e:
+                failed.append(e)
+    if failed:
+        util.logger.error("Creating %d of %d servers failed"
+                          % (len(failed), len(creates)))
+        _abort_batch(created, floating_ips_r)
+        raise failed[0]
+    servers = dict((s.id, s) for s in created)
+    i("Created %d servers, waiting for their fixed IPs" % len(servers))
+
+    prefix = os.path.commonprefix(names)
+    search_opts = ({'name': '^' + util.name_regex(prefix)} if prefix
+                   else None)
+    with util.phase('wait'):
+        try:
+            waits = waiter.wait_for_servers(servers.keys(),
+                                            waiter.has_fixed_ip,
+                                            search_opts=search_opts)
+            floating_ips = floating_ips_r.get()
+        except Exception:
+            _abort_batch(created, floating_ips_r)
+            raise
+
+    setups = dict((sid, pool.apply_async(_setup_server,
+                       (servers[sid], floating_ips, secgroup_ids)))
+                  for sid, w in waits.items() if not w.failed)
+
+    rows = []
+    with util.phase('setup'):
+        for sid, w in sorted(waits.items(),
+                             key=lambda x: servers[x[0]].name):
+            fixed = ','.join(sum(w.server.networks.values(), [])
+                             if w.server is not None else [])
+            floating = ''
+            if sid in setups:
+                try:
+                    floating = setups[sid].get()
+                except Exception as e:
+                    util.logger.error("Setting up server %s failed: %s"
+                                      % (sid, e))
+            rows.append({'id': sid, 'name': servers[sid].name,
+                         'status': w.status, 'fixed_ip': fixed,
+                         'floating_ip': floating})
+    # leases for the servers which failed to build
+    floating_ips.release_unused()
+
+    i("%d servers set up %.1fs after start" %
+      (len([r for r in rows if r['floating_ip']]), time.time() - start))
+    print "\t".join(['#id', 'name', 'status', 'fixed_ip', 'floating_ip'])
+    for r in rows:
+        print "\t".join([r['id'], r['name'], r['status'], r['fixed_ip'],
+                         r['floating_ip'] or '-'])
+    return (image, rows)
+
+
+def _boot(args, pool, start):
+    # resolve names to ids concurrently, none of it needs the others
+    image_r = pool.apply_async(resolve_image, (args.image,))
+    flavor_r = pool.apply_async(resolve_flavor, (args.flavor,))
+    secgroups_r = pool.apply_async(resolve_secgroups, (args.secgroups,))
+
+    with util.phase('resolve'):
+        _image = image_r.get()
+        _flavor = flavor_r.get()
+        secgroup_ids = secgroups_r.get()
+    pool.apply_async(warn_if_ssh_closed, (secgroup_ids,))
+
+    if args.test:
+        print "args are"
+        print args
+
+    params = make_params(args, _image, _flavor)
+    params['name'] = args.name
 
     if args.floatingip:
         if not is_valid_ipv4_address(args.floatingip):
@@ -217,54 +449,55 @@ def main(args_list):
             except socket.gaierror:
                 raise util.NovaWrapperError("name %s does not DNS translate" %
                                        args.floatingip)
-        i("Checking if ip %s is available" % args.floatingip)
-        while args.floatingip not in [ii.ip for ii in get_free_floating_ips()]:
-            i("ip not available, trying to allocate another from the pool")
-            allocate_floating_ip()
 
     i("Launching new server with parameters:\n%s" % pprint.pformat(params))
 
     if args.test:
-        util.GlanceProxy()
         i("This is a test run, _NOT_ booting the instance.")
         return (None, None)
     else:
-        new_server = _nova().servers.create(**params)
+        with util.phase('create'):
+            new_server = _nova().servers.create(**params)
         i("Created new server with id " + new_server.id)
 
+        # the floating IP is found or allocated while the server builds
+        floating_ip_r = pool.apply_async(reserve_floating_ip,
+                                         (args.floatingip,))
 
         i("About to assign a floating IP. For that, we need to wait till "
           "the vm will show a fixed IP address..")
 
-        server_id = new_server.id
-
-        while not server_has_a_fixed_ip(server_id):
-            status = _nova().servers.get(server_id).status
-            if status == 'ERROR':
+        try:
+            with util.phase('wait'):
+                wait = waiter.wait_for_servers(
+                    [new_server.id], waiter.has_fixed_ip)[new_server.id]
+            if wait.failed:
                 raise util.NovaWrapperError('Server got to ERROR status.')
-            if status != 'BUILD':
-                i("Server in weird status: %s" % status)
-            time.sleep(1)
-
-        if args.floatingip:
-            assigned_ip = get_free_floating_ip(args.floatingip)
-        else:
-            assigned_ip = dig_a_floating_ip()
-
-        i("Assigning floating IP %s to the new server" % assigned_ip)
-
-        new_server.add_floating_ip(assigned_ip)
-
-        secgroup_ids = []
-        all_sgs = _neutron().list_security_groups(
-            tenant_id=os.environ['OS_TENANT_ID'])
-        for sg in args.secgroups.split(','):
-            sgid  = find_resource_id_by_name(sg, all_sgs,
-                       use_getitem=True, subitem='security_groups')
-            secgroup_ids.append(sgid)
-
-        add_security_groups(new_server.id, secgroup_ids)
-
+            i("Server %s has fixed IP %s (%s)" % (new_server.id,
+              wait.server.networks.values(), wait))
+
+            with util.phase('setup'):
+                assigned_ip = floating_ip_r.get()
+
+                i("Assigning floating IP %s to the new server"
+                  % assigned_ip.ip)
+
+                # a floating IP given by the user is not replaced
+                assigned_ip = assign_floating_ip(
+                    new_server, assigned_ip,
+                    another=args.floatingip is None)
+
+                add_security_groups(new_server.id, secgroup_ids)
+        except Exception:
+            # the lease of a floating IP not assigned would be held for
+            # fippool.LEASE_TIME
+            floating_ip_r.wait()
+            if floating_ip_r.successful():
+                release_floating_ip(floating_ip_r.get())
+            raise
+
+        i("Server %s is set up %.1fs after start" %
+          (new_server.id, time.time() - start))
 
         util.callCheck("nova show " + new_server.id)
         return (new_server.image['id'], assigned_ip.ip)
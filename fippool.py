@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+# Warm pool of floating IPs.
+#
+# Keeps a number of allocated, unassociated floating IPs of the current
+# tenant in a local state file, so that fastnovaboot can take one without
+# listing all floating IPs. Claims and leases are done under a file lock, so
+# two concurrent boots never get the same IP. A lease is dropped when the IP
+# is released back to the pool, or after LEASE_TIME seconds. An assigned IP
+# stays marked as assigned until then, so that a boot which listed the
+# floating IPs just before the assignment doesn't lease it again.
+#
+# The pool is empty unless you give it a size, floating IPs are quota. Once it
+# has one, it's refilled by a background process each time an IP from the
+# pool gets assigned.
+#
+# $ fippool status
+# $ fippool -s 5 refill     # keep 5 free floating IPs in the pool from now on
+
+import argparse
+import collections
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import cachedb
+import util
+
+i = util.logger.info
+d = util.logger.debug
+
+STATE_FILE = cachedb.CACHE_DIR + '/fippool_%s.json'
+LOCK_FILE = cachedb.CACHE_DIR + '/fippool_%s.lock'
+REFILL_LOCK_FILE = cachedb.CACHE_DIR + '/fippool_%s.refill.lock'
+
+# default number of free floating IPs to keep in the pool of a tenant. No
+# floating IPs are allocated in advance unless it's set with fippool -s.
+POOL_SIZE = 0
+
+# claimed IP which was not reported as assigned, and the assigned mark of an
+# IP, are forgotten after this many seconds
+LEASE_TIME = 600
+
+Lease = collections.namedtuple('Lease', ['id', 'ip'])
+
+
+def get_free_floating_ips():
+    return [ ip for ip in util.NovaProxy().floating_ips.list()
+             if ip.instance_id is None ]
+
+
+def get_floating_ip_pool_name():
+    return util.NovaProxy().floating_ip_pools.list()[0].name
+
+
+def allocate_floating_ip(pool_name=None):
+    if pool_name is None:
+        pool_name = get_floating_ip_pool_name()
+    i("Found pool %s, will try to allocate one floating IP from it"
+      % pool_name)
+    try:
+        return util.NovaProxy().floating_ips.create(pool=pool_name)
+    except Exception as e:
+        # throttled calls were retried already (see util._schedule), so
+        # Nova means it: the pool is empty (404) or the quota is used (413)
+        status = util.http_status(e)
+        if status == 404:
+            raise util.NovaWrapperError("No more floating IPs in pool %s"
+                                        % pool_name)
+        if status == 413:
+            raise util.NovaWrapperError("Floating IP quota of tenant %s is "
+                                        "used up: %s" % (util._TENANT, e))
+        raise
+
+
+class _Locked(object):
+    """Exclusive access to state of the pool of a tenant."""
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+
+    def __enter__(self):
+        util.mkdirp(cachedb.CACHE_DIR)
+        self._lock_file = open(LOCK_FILE % self.tenant, 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            with open(STATE_FILE % self.tenant) as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            self.state = {}
+        self.state.setdefault('size', POOL_SIZE)
+        self.state.setdefault('free', [])
+        self.state.setdefault('leases', {})
+        now = time.time()
+        for ip, lease in self.state['leases'].items():
+            if lease['expires'] < now:
+                d("Lease of floating IP %s expired" % ip)
+                del self.state['leases'][ip]
+        return self
+
+    def save(self):
+        fd, tmp_path = tempfile.mkstemp(dir=cachedb.CACHE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_path, STATE_FILE % self.tenant)
+
+    def __exit__(self, *exc_info):
+        self._lock_file.close()
+
+
+def _add_lease(pool, fip_id, ip, pooled=False):
+    pool.state['leases'][ip] = {'id': fip_id, 'pid': os.getpid(),
+                                'expires': time.time() + LEASE_TIME}
+    if pooled:
+        pool.state['leases'][ip]['pooled'] = True
+    return Lease(fip_id, ip)
+
+
+def claim(count=1, tenant=None):
+    """Takes up to count free floating IPs from the pool, returns list of
+    Lease."""
+    tenant = tenant or util._TENANT
+    with _Locked(tenant) as pool:
+        claimed = pool.state['free'][:count]
+        pool.state['free'] = pool.state['free'][count:]
+        leases = [_add_lease(pool, fip['id'], fip['ip'], pooled=True)
+                  for fip in claimed]
+        pool.save()
+    return leases
+
+
+def _lease_listed(floating_ips, count, tenant):
+    """Leases up to count of floating_ips (objects with id and ip) which
+    are neither leased, assigned lately nor in the pool. Returns list of
+    Lease."""
+    with _Locked(tenant) as pool:
+        taken = (set(pool.state['leases']) |
+                 set(fip['ip'] for fip in pool.state['free']))
+        leases = [_add_lease(pool, fip.id, fip.ip)
+                  for fip in [f for f in floating_ips
+                              if f.ip not in taken][:count]]
+        pool.save()
+    return leases
+
+
+def lease_ip(ip, tenant=None):
+    """Returns Lease of the free floating IP with address ip, taking it from
+    the pool if it's there. Raises util.NovaWrapperError if the IP is not a
+    free floating IP of the tenant, or other boot holds it."""
+    tenant = tenant or util._TENANT
+    listed = [fip for fip in get_free_floating_ips() if fip.ip == ip]
+    if not listed:
+        raise util.NovaWrapperError("Floating IP %s is not allocated to "
+                                    "tenant %s, or it's assigned already"
+                                    % (ip, tenant))
+    with _Locked(tenant) as pool:
+        if ip in pool.state['leases']:
+            raise util.NovaWrapperError("Floating IP %s is taken by other "
+                                        "boot" % ip)
+        free = pool.state['free']
+        pool.state['free'] = [fip for fip in free if fip['ip'] != ip]
+        lease = _add_lease(pool, listed[0].id, ip,
+                           pooled=len(pool.state['free']) < len(free))
+        pool.save()
+    return lease
+
+
+def lease(count=1, tenant=None):
+    """Returns list of count Leases of free floating IPs: claimed from the
+    pool first, then unassigned floating IPs of the tenant which nobody else
+    holds, then newly allocated ones."""
+    tenant = tenant or util._TENANT
+    leases = claim(count, tenant)
+    try:
+        if len(leases) < count:
+            leases += _lease_listed(get_free_floating_ips(),
+                                    count - len(leases), tenant)
+        missing = count - len(leases)
+        if missing > 0:
+            i("There are no free allocated floating IPs for %d servers, "
+              "allocating them" % missing)
+            pool_name = get_floating_ip_pool_name()
+            allocated = [allocate_floating_ip(pool_name)
+                         for _ in range(missing)]
+            leases += _lease_listed(allocated, missing, tenant)
+    except Exception:
+        release(leases, tenant)
+        raise
+    return leases
+
+
+def claim_one(tenant=None):
+    """Returns Lease of a free floating IP, or None if the pool is empty."""
+    claimed = claim(1, tenant)
+    return claimed[0] if claimed else None
+
+
+def done(ip, tenant=None, used=True):
+    """Ends lease of floating IP, after it was assigned (or found unusable,
+    used=False). An assigned IP stays marked for LEASE_TIME, and if it was
+    from the pool, starts background refill."""
+    with _Locked(tenant or util._TENANT) as pool:
+        lease = pool.state['leases'].pop(ip, None)
+        if lease is None:
+            return
+        if used:
+            pool.state['leases'][ip] = {'id': lease['id'],
+                                        'pid': lease['pid'],
+                                        'assigned': True,
+                                        'expires': time.time() + LEASE_TIME}
+        pool.save()
+        refill = used and lease.get('pooled') and pool.state['size'] > 0
+    if refill:
+        refill_in_background()
+
+
+def release(leases, tenant=None):
+    """Drops leases of floating IPs which won't be assigned after all, and
+    puts them back to the pool as far as it has room. Leases which were done
+    already are skipped."""
+    with _Locked(tenant or util._TENANT) as pool:
+        for lease in leases:
+            held = pool.state['leases'].get(lease.ip)
+            if held is None or held.get('assigned'):
+                continue
+            del pool.state['leases'][lease.ip]
+            if len(pool.state['free']) < pool.state['size']:
+                pool.state['free'].append({'id': lease.id, 'ip': lease.ip})
+        pool.save()
+
+
+def give_back(floating_ips, tenant=None):
+    """Puts unassociated floating IPs (objects with id and ip) to the pool,
+    as many as fit to its size. Returns the ones which didn't fit."""
+    with _Locked(tenant or util._TENANT) as pool:
+        # they were unassigned since
+        for fip in floating_ips:
+            held = pool.state['leases'].get(fip.ip)
+            if held is not None and held.get('assigned'):
+                del pool.state['leases'][fip.ip]
+        room = max(0, pool.state['size'] - len(pool.state['free']))
+        pool.state['free'] += [{'id': fip.id, 'ip': fip.ip}
+                               for fip in floating_ips[:room]]
+        pool.save()
+    return floating_ips[room:]
+
+
+def leased_ips(tenant=None):
+    """Returns set of IPs which are leased, assigned lately or waiting in
+    the pool. Other boots shouldn't take them."""
+    with _Locked(tenant or util._TENANT) as pool:
+        return (set(pool.state['leases']) |
+                set(fip['ip'] for fip in pool.state['free']))
+
+
+def refill(tenant=None, size=None):
+    """Lists free floating IPs and allocates new ones until the pool has its
+    size. Returns the free floating IPs in the pool.
+
+    Does nothing if other refill of the pool is running.
+    """
+    tenant = tenant or util._TENANT
+    util.mkdirp(cachedb.CACHE_DIR)
+    refill_lock = open(REFILL_LOCK_FILE % tenant, 'w')
+    try:
+        fcntl.flock(refill_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        d("Floating IP pool of %s is being refilled already" % tenant)
+        return None
+    with refill_lock:
+        with _Locked(tenant) as pool:
+            if size is not None:
+                pool.state['size'] = size
+                pool.save()
+            size = pool.state['size']
+            leased = set(pool.state['leases'])
+        # the API calls are made without holding the state lock, so that
+        # claims are not blocked
+        free = [{'id': fip.id, 'ip': fip.ip}
+                for fip in get_free_floating_ips()
+                if fip.ip not in leased][:size]
+        if len(free) < size:
+            pool_name = get_floating_ip_pool_name()
+            for _ in range(size - len(free)):
+                allocated = allocate_floating_ip(pool_name)
+                free.append({'id': allocated.id, 'ip': allocated.ip})
+        with _Locked(tenant) as pool:
+            # drop what got claimed meanwhile
+            leased = set(pool.state['leases'])
+            pool.state['free'] = [free_ip for free_ip in free
+                                  if free_ip['ip'] not in leased]
+            pool.save()
+            return pool.state['free']
+
+
+def refill_in_background():
+    """Starts refill of the pool in a detached process."""
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'refill'],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Warm pool of free floating IPs for fastnovaboot')
+
+    help_size = ('number of free floating IPs to keep in the pool of the '
+                 'current tenant (remembered for later refills)')
+
+    parser.add_argument('action', choices=['status', 'refill'],
+                        nargs='?', default='status')
+    parser.add_argument('-s', '--size', help=help_size, type=int)
+    util.add_profile_args(parser)
+
+    return parser.parse_args(args_list)
+
+
+def main(args_list):
+    args = get_args(args_list)
+    util.setup_profile(args)
+    if args.action == 'refill':
+        refill(size=args.size)
+    with _Locked(util._TENANT) as pool:
+        print "Pool size %d, free:" % pool.state['size']
+        for fip in pool.state['free']:
+            print "  %s %s" % (fip['ip'], fip['id'])
+        print "Leased:"
+        for ip, lease in sorted(pool.state['leases'].items()):
+            print "  %s %s pid %d for %ds more" % (
+                ip, 'assigned by' if lease.get('assigned') else 'to',
+                lease['pid'], lease['expires'] - time.time())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
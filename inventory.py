@@ -0,0 +1,101 @@
+"""
+Inventory of clouds, regions and tenants, for caching and searching all of
+them at once instead of one OS_AUTH_URL and OS_TENANT_NAME at a time.
+
+The inventory is an INI file (INVENTORY_FILE), with a section per cloud:
+
+    [prod]
+    auth_url = https://cloud.forgeservicelab.fi:5001/v2.0
+    regions = regionOne
+    tenants = provisiontest digile
+
+Every combination of region and tenant of a cloud is a target. regions is
+optional, without it the first endpoint of each service in the catalog is
+used. The user and password are OS_USERNAME and OS_PASSWORD, unless the
+section sets username and/or password_env (the name of the environment
+variable holding the password).
+
+build_cache.py --inventory caches all the targets concurrently, each under
+its own name, cloud:region:tenant (cloud:tenant without regions), so that
+equally named tenants of different clouds don't mix. n --all and nssh --all
+search the caches of all the targets.
+"""
+
+import collections
+import ConfigParser
+import os
+
+import cache_client
+import cachedb
+import util
+
+INVENTORY_FILE = os.path.expanduser('~/.config/os_utils/inventory.ini')
+
+
+class Target(collections.namedtuple('Target', ['cloud', 'region', 'tenant',
+                                               'auth_url', 'username',
+                                               'password_env'])):
+    """A tenant in a region of a cloud."""
+
+    @property
+    def name(self):
+        """Name of the target, and of its cache."""
+        return ':'.join(p for p in (self.cloud, self.region, self.tenant)
+                        if p)
+
+    def session(self):
+        password = None
+        if self.password_env:
+            password = os.environ.get(self.password_env)
+            if password is None:
+                raise util.NovaWrapperError(
+                    "Environment variable %s with password for cloud %s is "
+                    "not set" % (self.password_env, self.cloud))
+        return util.TenantSession(self.tenant, auth_url=self.auth_url,
+                                  region=self.region,
+                                  username=self.username, password=password)
+
+
+def load(path=None):
+    """Returns list of Targets of the inventory file."""
+    path = path or INVENTORY_FILE
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(path):
+        raise util.NovaWrapperError("No inventory in %s, see inventory.py "
+                                    "for its format" % path)
+    targets = []
+    for cloud in parser.sections():
+        options = dict(parser.items(cloud))
+        if ':' in cloud or not options.get('auth_url') or \
+                not options.get('tenants'):
+            raise util.NovaWrapperError(
+                "Cloud %s in %s needs auth_url and tenants, and can't have "
+                "':' in its name" % (cloud, path))
+        for region in options.get('regions', '').split() or [None]:
+            for tenant in options['tenants'].split():
+                targets.append(Target(cloud, region, tenant,
+                                      options['auth_url'],
+                                      options.get('username'),
+                                      options.get('password_env')))
+    return targets
+
+
+def sessions(path=None):
+    """Returns OrderedDict of target name -> util.TenantSession of all
+    targets of the inventory."""
+    return collections.OrderedDict((t.name, t.session()) for t in load(path))
+
+
+def open_caches(path=None):
+    """Yields (target, cache) for each target of the inventory which has a
+    cache. The cache is closed when the next one is asked for."""
+    for target in load(path):
+        try:
+            cache = cache_client.open_cache(target.name)
+        except cachedb.CacheError as e:
+            util.logger.warning(str(e))
+            continue
+        try:
+            yield target, cache
+        finally:
+            cache.close()
@@ -12,10 +12,16 @@
 # 80,443 and 22 to 212.68.9.98/32 193.166.24.0/23
 # $ managesecgroup -n testenv -c -p 80 443 22 \
 #                  -i 212.68.9.98/32 193.166.24.0/23
+#
+# The current rules of the group are fetched once and only the missing ones
+# are added, adjacent ports merged to ranges, concurrently. With -x, TCP rules
+# not in the given ports and CIDRs are removed too, so the group ends up
+# exactly as specified. With -t, the script just shows what it would change.
 
 import argparse
 import sys
 import socket
+from multiprocessing.pool import ThreadPool
 
 import util
 
@@ -27,6 +33,10 @@ CIDR_ALIASES = {'digile': '83.150.108.249/32',
 
 desc = ('Create of modify security group')
 
+# how many rule API calls run at once
+CONCURRENCY = 8
+
+
 def check_CIDR(cidr):
     i("Checking if '%s' is a proper CIDR address" % cidr)
     ip, maskbitcount = cidr.split('/')
@@ -36,12 +46,71 @@ def check_CIDR(cidr):
     socket.inet_aton(ip)
 
 
+def parse_ports(ports):
+    """Returns set of ints from list of strings like "22" or "8000-8010"."""
+    parsed = set()
+    for p in ports:
+        from_port, _, to_port = p.partition('-')
+        parsed.update(range(int(from_port), int(to_port or from_port) + 1))
+    return parsed
+
+
+def merge_ranges(ports):
+    """Returns sorted list of (from_port, to_port) covering set of ports,
+    with adjacent ports merged."""
+    ranges = []
+    for p in sorted(ports):
+        if ranges and ranges[-1][1] == p - 1:
+            ranges[-1] = (ranges[-1][0], p)
+        else:
+            ranges.append((p, p))
+    return ranges
+
+
+def rule_key(rule):
+    """(from_port, to_port, cidr) of a TCP CIDR rule, None for other rules."""
+    cidr = (rule.get('ip_range') or {}).get('cidr')
+    if rule.get('ip_protocol') != 'tcp' or not cidr:
+        return None
+    return (rule['from_port'], rule['to_port'], cidr)
+
+
+def plan(rules, ports, cidrs, exact=False):
+    """Computes which rules to add and remove.
+
+    Only TCP rules with CIDR are considered, others are never removed.
+    Without exact, ports already open for a CIDR are skipped and nothing is
+    removed. With exact, the group ends up with exactly the given ports
+    (merged to ranges) for the given CIDRs.
+
+    Returns (list of (from_port, to_port, cidr) to add, list of rules to
+    remove).
+    """
+    existing = dict((rule_key(r), r) for r in rules if rule_key(r))
+    wanted = set((f, t, cidr) for cidr in cidrs
+                 for f, t in merge_ranges(ports))
+    if exact:
+        to_add = sorted(wanted - set(existing))
+        to_remove = [r for key, r in sorted(existing.items())
+                     if key not in wanted]
+        return to_add, to_remove
+    to_add = []
+    for cidr in cidrs:
+        missing = set(p for p in ports
+                      if not any(f <= p <= t and c == cidr
+                                 for f, t, c in existing))
+        to_add += [(f, t, cidr) for f, t in merge_ranges(missing)]
+    return to_add, []
+
+
 def get_args(args_list):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description=desc)
 
     help_create = 'create the security group first'
+    help_exact = ('make the TCP rules of the group exactly the given ports '
+                  'and CIDRs, removing the other TCP rules')
 
     parser.add_argument('-c', '--create', help=help_create, default=False,
                         action='store_true')
@@ -49,45 +118,81 @@ def get_args(args_list):
     parser.add_argument('-n', '--name', help='name of the sec group',
                         default='default', required=True)
 
-    parser.add_argument('-p', '--ports', help='space separated list of ports',
-                        nargs='+', default=['443', '80', '22'])
+    parser.add_argument('-p', '--ports', help='space separated list of ports '
+                        'or port ranges (8000-8010)', nargs='+',
+                        default=['443', '80', '22'])
 
     parser.add_argument('-i', '--cidrs', help='space separated list of CIDRs',
                         nargs='+', required=True)
 
-    parser.add_argument('-t', '--test', help='test run, dont change anything',
-                        action='store_true')
+    parser.add_argument('-x', '--exact', help=help_exact, action='store_true')
+
+    parser.add_argument('-t', '--test', help='test run, only show what would '
+                        'be changed', action='store_true')
+    util.add_profile_args(parser)
 
     return parser.parse_args(args_list)
 
 
 def main(args_list):
     args = get_args(args_list)
+    util.setup_profile(args)
     _nova = util.NovaProxy
 
-    sec_group = None
+    # if cidr is alias, try to get it from the alias dict,
+    # if it's not an alias, use it as CIDR:
+    cidrs = [CIDR_ALIASES.get(cidr, cidr) for cidr in args.cidrs]
+    for cidr in cidrs:
+        check_CIDR(cidr)
+    ports = parse_ports(args.ports)
 
-    if not args.test:
-        if args.create:
+    sec_group = None
+    rules = []
+    if args.create:
+        if not args.test:
             sec_group = _nova().security_groups.create(args.name, args.name)
-        else:
-            sec_group = _nova().security_groups.find(name=args.name)
-
-    for port in args.ports:
-        for cidr in args.cidrs:
-            true_cidr = CIDR_ALIASES.get(cidr, cidr)
-            check_CIDR(true_cidr)
-            i("adding rule: port %s, cidr %s " % (port, cidr))
-            if not args.test:
-                _nova().security_group_rules.create(sec_group.id,
-                    ip_protocol='tcp', from_port=port, to_port=port,
-                    # if cidr is alias, try to get it from the alias dict,
-                    # if it's not an alias, use it as CIDR:
-                    cidr=true_cidr)
-            else:
-                i('This is just a test, the rule is not added')
+    else:
+        sec_group = _nova().security_groups.find(name=args.name)
+        rules = sec_group.rules
+
+    to_add, to_remove = plan(rules, ports, cidrs, args.exact)
+
+    for r in to_remove:
+        i("removing rule: ports %s-%s, cidr %s" % rule_key(r))
+    for from_port, to_port, cidr in to_add:
+        i("adding rule: ports %s-%s, cidr %s" % (from_port, to_port, cidr))
+    if not to_add and not to_remove:
+        i("Security group %s is up to date" % args.name)
+
+    if args.test:
+        i('This is just a test, no rules are changed')
+        return 0
+
+    pool = ThreadPool(CONCURRENCY)
+    try:
+        # the new rules must be in place before the old ones go, so that
+        # replaced ports are never closed. If any create fails, nothing is
+        # removed.
+        creates = [pool.apply_async(_nova().security_group_rules.create,
+                       (sec_group.id,), dict(ip_protocol='tcp',
+                           from_port=from_port, to_port=to_port, cidr=cidr))
+                   for from_port, to_port, cidr in to_add]
+        for c in creates:
+            c.wait()
+        for c in creates:
+            c.get()
+        deletes = [pool.apply_async(_nova().security_group_rules.delete,
+                                    (r['id'],)) for r in to_remove]
+        for c in deletes:
+            c.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    i("Security group %s: %d rules added, %d removed" %
+      (args.name, len(to_add), len(to_remove)))
+    return 0
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
-
+    sys.exit(main(sys.argv[1:]))
@@ -1,27 +1,172 @@
 #!/usr/bin/env python
 
 # much faster alternative to "nova list" it needs the cache in place.
-# See build_cache.py for how to set up the cache building
+# See build_cache.py for how to set up the cache building. If cache_daemon.py
+# runs, the instances are asked from it instead.
+#
+# With --all, instances of all clouds, regions and tenants of the inventory
+# (see inventory.py) are listed, each line starting with cloud:region:tenant.
+#
+# The cache is printed right away even when it's older than --max-age, but
+# then build_cache.py is started in the background to refresh just that
+# tenant. A lock file per tenant makes sure only one such refresh runs at a
+# time. A tenant without cache is fetched from the API once, which fills the
+# cache for the next runs. Caches served by cache_daemon.py are kept fresh by
+# the daemon.
 
-import json
+import argparse
 import build_cache
+import cache_client
+import cachedb
+import inventory
+import json
 import os
+import subprocess
 import sys
+import time
+import util
+
+# cache older than this many seconds is refreshed in the background
+MAX_AGE = 300
+
+REFRESH_LOCK_FILE = cachedb.CACHE_DIR + '/.refresh_%s.lock'
+REFRESH_LOG_FILE = cachedb.CACHE_DIR + '/refresh_%s.log'
+
+BUILD_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'build_cache.py')
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='fast nova list from local cache')
+
+    help_names = 'print only names of instances (for shell completion)'
+    help_all = ('list instances of all clouds, regions and tenants of '
+                'inventory FILE')
+    help_name = 'list only instances with names containing this'
+    help_ip = ('list only instances with this fixed or floating IP, or '
+               'Forge hostname (ip-a-b-c-d.%s)' % util.FORGE_DOMAIN)
+    help_status = 'list only instances in this status, i.e. ACTIVE'
+    help_json = 'print instances as JSON list'
+    help_max_age = 'refresh cache older than this many seconds'
+
+    parser.add_argument('--names', help=help_names, action='store_true')
+    parser.add_argument('-a', '--all', help=help_all, metavar='FILE',
+                        nargs='?', const=inventory.INVENTORY_FILE)
+    parser.add_argument('-n', '--name', help=help_name)
+    parser.add_argument('-i', '--ip', help=help_ip)
+    parser.add_argument('-s', '--status', help=help_status)
+    parser.add_argument('-j', '--json', help=help_json, action='store_true')
+    parser.add_argument('--max-age', help=help_max_age, type=int,
+                        default=MAX_AGE)
+
+    return parser.parse_args(args_list)
+
+
+def refresh_running(tenant):
+    lock = build_cache.acquire_lock(REFRESH_LOCK_FILE % tenant)
+    if lock is None:
+        return True
+    lock.close()
+    return False
+
+
+def refresh_in_background(tenant, inventory_file=None):
+    """Starts build_cache.py refreshing the cache of tenant, unless one is
+    running already. Its output goes to REFRESH_LOG_FILE."""
+    if refresh_running(tenant):
+        return
+    command = [sys.executable, BUILD_CACHE, '-i', '-t', tenant,
+               '--lock', REFRESH_LOCK_FILE % tenant]
+    if inventory_file:
+        command += ['--inventory', inventory_file]
+    with open(os.devnull) as devnull:
+        with open(REFRESH_LOG_FILE % tenant, 'a') as log:
+            # in its own session, so that it survives the shell closing
+            subprocess.Popen(command, stdin=devnull, stdout=log, stderr=log,
+                             close_fds=True, preexec_fn=os.setsid)
+
+
+def open_caches(tenants, inventory_file=None):
+    """Returns list of (tenant, cache). Tenants without cache are fetched
+    from the API first."""
+    caches, missing = [], []
+    for t in tenants:
+        try:
+            caches.append((t, cache_client.open_cache(t)))
+        except cachedb.CacheError:
+            missing.append(t)
+    if missing:
+        util.logger.info("No cache for %s, fetching from the API"
+                         % ', '.join(missing))
+        sessions = None
+        if inventory_file:
+            sessions = inventory.sessions(inventory_file)
+        util.mkdirp(cachedb.CACHE_DIR)
+        build_cache.refresh(missing, sessions=sessions)
+        for t in missing:
+            try:
+                caches.append((t, cachedb.Cache(t)))
+            except cachedb.CacheError as e:
+                util.logger.error(str(e))
+    return caches
+
+
+def select(cache, args):
+    if args.ip:
+        rows = [r for r in cache.instances_by_address(args.ip)
+                if args.name is None or args.name in r['name']]
+    else:
+        rows = cache.instances(args.name)
+    if args.status:
+        rows = [r for r in rows if r['status'].lower() ==
+                args.status.lower()]
+    return rows
+
+
+def as_dict(row):
+    return {'id': row['id'], 'name': row['name'], 'status': row['status'],
+            'image_id': row['image_id'], 'fixed': row['fixed'].split(),
+            'floating': row['floating'].split(),
+            'secgroups': json.loads(row['secgroups'] or '[]')}
 
-cache_file = build_cache.INSTANCES_CACHE_FILE % os.environ['OS_TENANT_NAME']
 
 def main(args_list):
-    with open(cache_file, 'r') as f:
-        for l in f:
-            before_ips = l.find('{')
-            uid, name = l[:before_ips].strip().split(' ', 1)
-            float_ip = json.loads(l[before_ips:])['floating']
-            if not float_ip:
-                float_ip = '[NO_PUBLIC_IPS]'
-            print uid, float_ip, name
+    args = get_args(args_list)
+    if args.all:
+        tenants = [t.name for t in inventory.load(args.all)]
+    elif os.environ.get('OS_TENANT_NAME'):
+        tenants = [os.environ['OS_TENANT_NAME']]
+    else:
+        raise util.NovaWrapperError("OS_TENANT_NAME is not set, source your "
+                                    "openrc or use --all")
 
-if __name__ == "__main__":
-    sys.exit(main(sys.argv[1:]))
+    listed, stale = [], []
+    for tenant, cache in open_caches(tenants, args.all):
+        try:
+            listed.extend((tenant, r) for r in select(cache, args))
+            if time.time() - cache.updated > args.max_age and \
+                    not isinstance(cache, cache_client.DaemonCache):
+                stale.append(tenant)
+        finally:
+            cache.close()
 
+    if args.json:
+        print json.dumps([dict(as_dict(r), tenant=t) for t, r in listed],
+                         indent=2)
+    else:
+        for tenant, s in listed:
+            if args.names:
+                print s['name']
+                continue
+            float_ip = s['floating'] or '[NO_PUBLIC_IPS]'
+            prefix = [tenant] if args.all else []
+            print ' '.join(prefix + [s['id'], float_ip, s['name']])
 
+    for tenant in stale:
+        refresh_in_background(tenant, args.all)
+    return 0
 
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
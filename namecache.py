@@ -0,0 +1,125 @@
+"""
+Cache of name -> id resolution of images, flavors and security groups.
+
+Resolving a name needs a complete listing of the resource kind, which is slow
+for Glance images. The listings (just ids and names) are kept in a file per
+tenant for TTLS seconds. If the database written by build_cache.py is fresher
+than that, it's used instead of an API call. When a name is not found in
+cached data, the cached listing is dropped and the lookup is retried once
+with a fresh listing.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import cachedb
+import util
+
+d = util.logger.debug
+
+NAMES_FILE = cachedb.CACHE_DIR + '/names_%s.json'
+
+# how long listings of resource kinds are considered valid, in seconds
+TTLS = {'image': 3600,
+        'flavor': 24 * 3600,
+        'secgroup': 600}
+
+# resource kinds which build_cache.py caches, and their cachedb methods
+BUILD_CACHE_KINDS = {'image': 'images',
+                     'secgroup': 'secgroups'}
+
+_lock = threading.Lock()
+
+
+def _names_file(tenant):
+    return NAMES_FILE % tenant
+
+
+def _load(tenant):
+    try:
+        with open(_names_file(tenant)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _store(tenant, kind, entries):
+    with _lock:
+        data = _load(tenant)
+        data[kind] = {'updated': time.time(), 'entries': entries}
+        util.mkdirp(cachedb.CACHE_DIR)
+        fd, tmp_path = tempfile.mkstemp(dir=cachedb.CACHE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, _names_file(tenant))
+
+
+def _from_build_cache(kind, tenant):
+    if kind not in BUILD_CACHE_KINDS:
+        return None
+    try:
+        cache = cachedb.Cache(tenant)
+    except cachedb.CacheError:
+        return None
+    try:
+        if time.time() - cache.updated > TTLS[kind]:
+            return None
+        return [[r['id'], r['name']]
+                for r in getattr(cache, BUILD_CACHE_KINDS[kind])()]
+    finally:
+        cache.close()
+
+
+def _entries(kind, lister, tenant, fresh):
+    """Returns (list of [id, name], True if it was listed from the API)."""
+    tenant = tenant or util._TENANT
+    if not fresh:
+        cached = _load(tenant).get(kind)
+        if cached and time.time() - cached['updated'] <= TTLS[kind]:
+            return cached['entries'], False
+        from_build_cache = _from_build_cache(kind, tenant)
+        if from_build_cache is not None:
+            return from_build_cache, False
+    d("Listing %ss of tenant %s" % (kind, tenant))
+    listed = [[rid, name] for rid, name in lister()]
+    _store(tenant, kind, listed)
+    return listed, True
+
+
+def entries(kind, lister, tenant=None, fresh=False):
+    """Returns list of [id, name] of resource kind.
+
+    lister is called to get (id, name) pairs from the API when there's no
+    valid cached listing, or when fresh is True.
+    """
+    return _entries(kind, lister, tenant, fresh)[0]
+
+
+def resolve(kind, name, lister, tenant=None):
+    """Returns id of resource of given kind with given name (or id).
+
+    Raises util.NovaWrapperError if there's not exactly one such resource.
+    """
+    try:
+        uuid.UUID(name)
+        # name is uuid
+        return name
+    except ValueError:
+        pass
+    as_dicts = lambda l: [{'id': rid, 'name': n} for rid, n in l]
+    listed, from_api = _entries(kind, lister, tenant, False)
+    try:
+        return util.find_resource_id_by_name(
+            name, as_dicts(listed), use_getitem=True)
+    except util.NovaWrapperError:
+        if from_api:
+            # the listing is fresh already, listing again won't help
+            raise
+        d("%s %s not found in cache, listing again" % (kind, name))
+        return util.find_resource_id_by_name(
+            name, as_dicts(entries(kind, lister, tenant, fresh=True)),
+            use_getitem=True)
@@ -2,24 +2,107 @@
 
 # script that deletes all vms in current tenant
 # if an argument is passed, only vms with mathcing names are deleted
+#
+# Deletes are issued concurrently (see --concurrency), util schedules them
+# within the rate the API allows. The script then waits until the servers
+# are really gone (one batched poll for all of them) and releases their
+# floating IPs: first to the warm pool of fippool.py if it has room, the rest
+# back to the cloud.
 
 import argparse
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
+import fippool
 import util
+import waiter
+
+i = util.logger.info
 
 desc = 'Script deleting Openstack VMs matching given substring'
 
+# how many delete calls run at once
+CONCURRENCY = 10
+
+def delete_server(server):
+    util.NovaProxy().servers.delete(server.id)
+
+
+def release_floating_ips(floating_ips):
+    """Puts floating IPs to the warm pool, deallocates the rest."""
+    deallocate = fippool.give_back(floating_ips)
+    for fip in deallocate:
+        i("Releasing floating IP %s" % fip.ip)
+        util.NovaProxy().floating_ips.delete(fip.id)
+    return len(floating_ips) - len(deallocate), len(deallocate)
+
+
 def main(args_list):
     args = get_args(args_list)
+    util.setup_profile(args)
+    util.share_http_pool(args.concurrency)
+    start = time.time()
 
-    matching = [ s for s in util.NovaProxy().servers.list()
+    # Nova matches name as a regex, which narrows the listing
+    matching = [ s for s in util.NovaProxy().servers.list(
+                     search_opts={'name': util.name_regex(args.substring)})
                  if args.substring in s.name ]
 
     for s in matching:
         util.logger.info("Removing server %s" % s)
-        if not args.test:
-            util.NovaProxy().servers.delete(s.id)
+    if args.test or not matching:
+        return 0
+
+    ids = set(s.id for s in matching)
+    floating_ips = [ip for ip in util.NovaProxy().floating_ips.list()
+                    if ip.instance_id in ids]
+
+    pool = ThreadPool(max(1, args.concurrency))
+    try:
+        with util.phase('delete'):
+            results = [(s, pool.apply_async(delete_server, (s,)))
+                       for s in matching]
+            deleted = []
+            for s, r in results:
+                try:
+                    r.get()
+                    deleted.append(s)
+                except Exception as e:
+                    util.logger.error("Deleting server %s failed: %s"
+                                      % (s, e))
+    finally:
+        pool.close()
+        pool.join()
+
+    with util.phase('wait'):
+        try:
+            waits = waiter.wait_for_servers(
+                [s.id for s in deleted], waiter.is_gone, stop_on_error=False,
+                search_opts={'name': util.name_regex(args.substring)})
+        except waiter.ServerWaitError as e:
+            util.logger.error(str(e))
+            waits = e.waits
+    # floating IPs of servers still being deleted are not free yet
+    gone = [s for s in deleted if waits[s.id].done]
+    pending = [s for s in deleted if not waits[s.id].done]
+    gone_ids = set(s.id for s in gone)
+    pooled, released = 0, 0
+    if not args.keep_ips:
+        with util.phase('release'):
+            pooled, released = release_floating_ips(
+                [ip for ip in floating_ips if ip.instance_id in gone_ids])
+
+    print "Removed %d of %d servers in %.1fs:" % (
+        len(gone), len(matching), time.time() - start)
+    for s in gone:
+        print "  %s %s (%s)" % (s.id, s.name, waits[s.id])
+    if pending:
+        print "Still being deleted:"
+        for s in pending:
+            print "  %s %s" % (s.id, s.name)
+    print "Floating IPs: %d put to the pool, %d released" % (pooled, released)
+    return 0 if len(gone) == len(matching) else 1
 
 
 def get_args(args_list):
@@ -28,11 +111,17 @@ def get_args(args_list):
        description=desc)
     help_test = 'Dont delete, just say which servers match'
     help_substring = 'Substring to match the server names'
+    help_concurrency = 'how many delete calls run at once'
+    help_keep_ips = "don't release floating IPs of the deleted servers"
     parser.add_argument('-t', '--test', help=help_test, action='store_true')
     parser.add_argument('-s', '--substring', help=help_test,
                         required=True)
+    parser.add_argument('-j', '--concurrency', help=help_concurrency,
+                        type=int, default=CONCURRENCY)
+    parser.add_argument('-k', '--keep-ips', help=help_keep_ips,
+                        action='store_true')
+    util.add_profile_args(parser)
     return parser.parse_args(args_list)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
-
@@ -13,18 +13,109 @@
 # In order for the script to work, the key must be ok, network must
 # be working. The script will attempt to ssh as root. If it detects
 # Ubuntu image, it will ssh as "ubuntu".
+#
+# Instance, its floating IP and image name are looked up in the local cache
+# (see build_cache.py, or cache_daemon.py if it runs) first. The API is asked
+# only when the instance is not in the cache, or when connecting to the
+# cached address fails.
+#
+# Instead of a name, you can give an IP (fixed or floating) or a Forge
+# hostname of the instance, it's found by the address index of the cache with
+# one lookup. --resolve just prints the instances with the address.
+#
+# With --all, the instance is searched in the caches of all clouds, regions
+# and tenants of the inventory (see inventory.py), and the API of the one it
+# was found in is used.
 
 import argparse
+import json
 
+import cache_client
+import cachedb
+import inventory
+import secrules
+import sshprobe
 import util
 import uuid
 import sys
 
 i = util.logger.info
+d = util.logger.debug
+
+# exit status of ssh when it can't connect
+SSH_CONNECTION_ERROR = 255
+
+
+class CachedServer(object):
+    """Server as known from the local cache, enough to connect to it."""
+
+    def __init__(self, row, target=None):
+        self.target = target
+        self.id = row['id']
+        self.name = row['name']
+        self.status = row['status']
+        self.image = {'id': row['image_id']}
+        self.floating = row['floating'].split()
+        self.security_groups = [{'name': n}
+                                for n in json.loads(row['secgroups'] or '[]')]
+
+    def __str__(self):
+        if self.target is not None:
+            return "<Server: %s in %s>" % (self.name, self.target.name)
+        return "<Server: %s>" % self.name
+
+
+def _nova(target=None):
+    """Nova of inventory target, of the current tenant if it's None."""
+    if target is None:
+        return util.NovaProxy()
+    return target.session().nova()
 
 
-def get_floating_ip_of_instance(instance_id):
-    ips = [ip for ip in util.NovaProxy().floating_ips.list()
+def get_cache(target=None):
+    try:
+        return cache_client.open_cache(target.name if target is not None
+                                       else util._TENANT)
+    except cachedb.CacheError as e:
+        d(str(e))
+        return None
+
+
+def _cached_rows(cache, name):
+    if util.is_address(name):
+        return cache.instances_by_address(name)
+    try:
+        uuid.UUID(name)
+        return [r for r in [cache.instance(name)] if r is not None]
+    except ValueError:
+        return cache.instances(name)
+
+
+def get_cached_vms(name, inventory_file=None, floating_only=True,
+                   cache=None):
+    """Like get_matching_vms, but from cache, or from the caches of all
+    targets of inventory_file if it's given. Unless floating_only is False,
+    only instances with a floating IP are returned."""
+    if inventory_file:
+        return [CachedServer(r, target)
+                for target, target_cache
+                in inventory.open_caches(inventory_file)
+                for r in _cached_rows(target_cache, name)
+                if r['floating'] or not floating_only]
+    if cache is None:
+        return []
+    return [CachedServer(r) for r in _cached_rows(cache, name)
+            if r['floating'] or not floating_only]
+
+
+def get_floating_ip_address(vm):
+    if isinstance(vm, CachedServer):
+        return vm.floating[0]
+    return get_floating_ip_of_instance(vm.id).ip
+
+
+def get_floating_ip_of_instance(instance_id, target=None):
+    ips = [ip for ip in _nova(target).floating_ips.list()
            if ip.instance_id == instance_id]
     if not ips:
         raise util.NovaWrapperError("Instance %s does not have a floating IP"
@@ -32,20 +123,32 @@ def get_floating_ip_of_instance(instance_id):
     return ips[0]
 
 
-def check_port_open(vm, port):
+def check_port_open(vm, port, address=None):
+    """Returns True if TCP port of vm is open to address (to anyone if
+    address is None) in some security group of the vm."""
     secgroup_names = [sg['name'] for sg in vm.security_groups]
+    target = getattr(vm, 'target', None)
+    index = secrules.load(target and target.name, nova=_nova(target))
+    return index.reachable(secgroup_names, port, address)
+
 
-    secgroups = [sg for sg in util.NovaProxy().security_groups.list()
-                 if sg.name in secgroup_names]
-    relevant_rules = sum([sg.rules for sg in secgroups], [])
-    for rule in relevant_rules:
-        if rule['from_port'] and rule['to_port']:
-            if rule['from_port'] <= port <= rule['to_port']:
-                return True
-    return False
+def get_vms_by_address(address, target=None):
+    """Returns servers with given fixed or floating IP or Forge hostname.
+    """
+    nova = _nova(target)
+    ip = util.forge_hostname_ip(address) or address
+    ids = [f.instance_id for f in nova.floating_ips.list()
+           if f.ip == ip and f.instance_id]
+    if ids:
+        return [nova.servers.get(i) for i in ids]
+    # the ip filter of Nova matches fixed addresses, as a regular expression
+    return nova.servers.list(
+        search_opts={'ip': '^%s$' % util.name_regex(ip)})
 
 
 def get_matching_vms(name):
+    if util.is_address(name):
+        return get_vms_by_address(name)
     try:
         uuid.UUID(name)
         # name is UUID
@@ -54,10 +157,25 @@ def get_matching_vms(name):
         return [ m for m in util.NovaProxy().servers.list() if name in m.name ]
 
 
-def get_ssh_user(image_id):
+def get_image_name(image_id, target=None, cache=None):
+    """Image name from cache, from the cache of target if it's given."""
+    if target is not None:
+        cache = get_cache(target)
+    try:
+        if cache is not None:
+            row = cache.image(image_id)
+            if row is not None:
+                return row['name']
+    finally:
+        if target is not None and cache is not None:
+            cache.close()
+    return _nova(target).images.get(image_id).name
+
+
+def get_ssh_user(image_id, target=None, cache=None):
     ssh_user = 'root'
 
-    image_name = util.NovaProxy().images.get(image_id).name
+    image_name = get_image_name(image_id, target, cache)
 
     if 'ubuntu' in image_name.lower():
         ssh_user = 'ubuntu'
@@ -74,16 +192,16 @@ def get_ssh_user(image_id):
 
 
 def test_ssh_connection(ssh_user, ip):
-    try:
-        ssh_cmd = ("ssh -q -o ConnectTimeout=3 -i %s %s@%s exit" %
-                  (util.PRIVKEY_FILE, ssh_user, ip))
-        util.callCheck(ssh_cmd)
+    # checking the banner is much cheaper than forking ssh
+    if sshprobe.read_banner(ip) is None:
+        i("sshd on %s doesn't answer with SSH banner" % ip)
+        return -1
+    if sshprobe.ssh_login(ssh_user, ip):
         i("Sucessfully connected to %s" % ip)
         return 0
-    except:
-        i("Failed when attempting to open ssh connection as %s" %
-          ssh_cmd)
-        return -1
+    i("Failed when attempting to open ssh connection as %s@%s" %
+      (ssh_user, ip))
+    return -1
 
 
 def ask():
@@ -91,7 +209,8 @@ def ask():
     i = 1
     print "Current tenant is \"%s\". There are following VMs:" % util._TENANT
     for s in l:
-        addresses = [a['addr'] for a in s.addresses.values()[0]]
+        addresses = [a['addr'] for network in s.addresses.values()
+                     for a in network]
         print "%d: %s, %s" % (i, s, addresses)
         i += 1
 
@@ -110,6 +229,10 @@ def get_args(args_list):
 
     help_test = ('Just check if the ssh connection can be open, and quit.')
     help_printhostname = ('just print Forge hostname of the instance')
+    help_resolve = ('just print the instances with the IP or Forge hostname '
+                    'given instead of name')
+    help_all = ('search the instance in the caches of all clouds, regions '
+                'and tenants of inventory FILE')
 
     parser.add_argument('instance_name', nargs='?',
                         help='name of instance to ssh to')
@@ -124,12 +247,45 @@ def get_args(args_list):
     parser.add_argument('-s', '--sshcheck', help=help_sshcheck,
                         action='store_true')
     parser.add_argument('-t', '--test', help=help_test, action='store_true')
+    parser.add_argument('-r', '--resolve', help=help_resolve,
+                        action='store_true')
+    parser.add_argument('-a', '--all', help=help_all, metavar='FILE',
+                        nargs='?', const=inventory.INVENTORY_FILE)
+    util.add_profile_args(parser)
 
     return parser.parse_args(args_list)
 
 
+def get_command(args, ssh_user, ip):
+    if args.upload:
+        return "scp -i %s %s %s@%s:" % (util.PRIVKEY_FILE, args.upload,
+                                        ssh_user, ip)
+    elif args.download:
+        return "scp -i %s %s@%s:%s ./" % (util.PRIVKEY_FILE, ssh_user,
+                                          ip, args.download)
+    return "ssh -X -i %s %s@%s" % (util.PRIVKEY_FILE, ssh_user, ip)
+
+
+def connect(args, ssh_user, ip):
+    """Returns exit status of ssh (or scp)."""
+    if args.test:
+        return test_ssh_connection(ssh_user, ip)
+    return util.call(get_command(args, ssh_user, ip))
+
+
 def main(args_list):
     args = get_args(args_list)
+    util.setup_profile(args)
+    # the cache of the current tenant, inventory caches are opened as needed
+    cache = None if args.all else get_cache()
+    try:
+        return run(args, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def run(args, cache):
     vm = None
 
     if args.download and args.upload:
@@ -138,47 +294,64 @@ def main(args_list):
     if not args.instance_name:
         vm = ask()
     else:
-        matching_vms = get_matching_vms(args.instance_name)
+        if args.resolve and not util.is_address(args.instance_name):
+            raise util.NovaWrapperError("%s is not an IP or Forge hostname"
+                                        % args.instance_name)
+        matching_vms = get_cached_vms(args.instance_name, args.all,
+                                      floating_only=not args.resolve,
+                                      cache=cache)
+        if not matching_vms and not args.all:
+            matching_vms = get_matching_vms(args.instance_name)
         if not matching_vms:
             raise util.NovaWrapperError("no vm matches name %s"
                                         % args.instance_name)
         if args.printhostname:
             for v in matching_vms:
-                fip = get_floating_ip_of_instance(v.id)
-                hostname = 'ip-' + fip.ip.replace('.', '-')
-                hostname += '.hosts.forgeservicelab.fi'
-                print "%s: %s" % (v, hostname)
+                fip = get_floating_ip_address(v)
+                print "%s: %s" % (v, util.forge_hostname(fip))
+            return 0
+        if args.resolve:
+            for v in matching_vms:
+                print "%s %s" % (v.id, v)
             return 0
 
         vm = matching_vms[0]
 
     i("Will attempt to reach sshd on instance %s" % vm)
+    target = getattr(vm, 'target', None)
 
     if not args.user:
-        ssh_user = get_ssh_user(vm.image['id'])
+        ssh_user = get_ssh_user(vm.image['id'], target, cache)
     else:
         ssh_user = args.user
 
-    fip = get_floating_ip_of_instance(vm.id)
+    ip = get_floating_ip_address(vm)
 
     if args.sshcheck:
         i('checking if SSH is open in some secgroup')
         if not check_port_open(vm, 22):
             raise util.NovaWrapperError("Port 22 is not open in any security "
                                         "group in the machine.")
-    if args.test:
-        return test_ssh_connection(ssh_user, fip.ip)
-    else:
-        if args.upload:
-            cmd = "scp -i %s %s %s@%s:" % (util.PRIVKEY_FILE, args.upload,
-                                           ssh_user, fip.ip)
-        elif args.download:
-            cmd = "scp -i %s %s@%s:%s ./" % (util.PRIVKEY_FILE, ssh_user,
-                                             fip.ip, args.download)
-        else:
-            cmd = "ssh -X -i %s %s@%s" % (util.PRIVKEY_FILE, ssh_user, fip.ip)
-        util.callCheck(cmd)
 
+    ret = connect(args, ssh_user, ip)
+    if ret != 0 and isinstance(vm, CachedServer) and (
+            args.test or ret == SSH_CONNECTION_ERROR):
+        i("Connecting to cached address %s failed, checking instance %s in "
+          "the API" % (ip, vm.id))
+        try:
+            api_ip = get_floating_ip_of_instance(vm.id, target).ip
+        except util.NovaWrapperError as e:
+            # the instance is gone or has no floating IP anymore
+            i(str(e))
+            api_ip = ip
+        if api_ip != ip:
+            ip = api_ip
+            ret = connect(args, ssh_user, ip)
+
+    if args.test:
+        return ret
+    if ret != 0:
+        raise Exception("%s failed." % get_command(args, ssh_user, ip))
     return 0
 
 
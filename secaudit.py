@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# script showing which TCP ports of instances are reachable according to
+# their security groups
+#
+# Examples:
+#
+# which instances have ssh open to anyone:
+# $ secaudit
+#
+# can 1.2.3.4 reach ports 80 and 443 of instances with "web" in name:
+# $ secaudit -p 80 443 -a 1.2.3.4 -s web
+#
+# Instances and security group rules are taken from the build_cache.py cache
+# if it's fresh, otherwise from the API. The rules are compiled once into
+# secrules.RuleIndex, so each check is a couple of lookups.
+
+import argparse
+import json
+import sys
+import time
+
+import cachedb
+import secrules
+import util
+
+d = util.logger.debug
+
+desc = 'Show which ports of instances their security groups open'
+
+
+def cached_instances(substring, max_age):
+    """Returns list of (id, name, secgroup names) from the cache, None if
+    there's no fresh cache."""
+    try:
+        cache = cachedb.Cache(util._TENANT)
+    except cachedb.CacheError as e:
+        d(str(e))
+        return None
+    try:
+        if time.time() - cache.updated > max_age:
+            return None
+        return [(r['id'], r['name'], json.loads(r['secgroups'] or '[]'))
+                for r in cache.instances(substring)]
+    finally:
+        cache.close()
+
+
+def live_instances(substring):
+    return [(s.id, s.name, [sg['name'] for sg in
+                            getattr(s, 'security_groups', None) or []])
+            for s in util.NovaProxy().servers.list(
+                search_opts={'name': util.name_regex(substring or '')})
+            if (substring or '') in s.name]
+
+
+def get_args(args_list):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=desc)
+    help_ports = 'TCP ports to check'
+    help_address = ('source IPv4 address to check the ports from. Without it, '
+                    'a port counts as open if any rule opens it')
+    help_substring = 'check only instances with names containing this'
+    help_live = "don't use the cache, ask the API"
+    help_open = 'list only the open ports'
+    parser.add_argument('-p', '--ports', help=help_ports, type=int,
+                        nargs='+', default=[22])
+    parser.add_argument('-a', '--address', help=help_address)
+    parser.add_argument('-s', '--substring', help=help_substring)
+    parser.add_argument('-l', '--live', help=help_live, action='store_true')
+    parser.add_argument('-o', '--open', help=help_open, action='store_true')
+    util.add_profile_args(parser)
+    return parser.parse_args(args_list)
+
+
+def main(args_list):
+    args = get_args(args_list)
+    util.setup_profile(args)
+    instances, index = None, None
+    if not args.live:
+        instances = cached_instances(args.substring, secrules.MAX_CACHE_AGE)
+        index = secrules.from_cache()
+    if instances is None or index is None:
+        instances = live_instances(args.substring)
+        index = secrules.from_nova()
+
+    for instance_id, name, secgroups in sorted(instances,
+                                               key=lambda x: x[1]):
+        for port in args.ports:
+            allowing = index.allowing(secgroups, port, args.address)
+            if allowing:
+                print "%s\t%s\t%d\topen\t%s" % (instance_id, name, port,
+                                                ','.join(allowing))
+            elif not args.open:
+                print "%s\t%s\t%d\tclosed\t-" % (instance_id, name, port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
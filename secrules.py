@@ -0,0 +1,187 @@
+"""
+Index of security group rules for port reachability queries.
+
+Ingress rules of security groups (in Nova or Neutron format) are compiled
+per group and protocol: the port space is cut at the rule boundaries into
+segments, found by bisection, and each segment keeps the source networks of
+the rules covering it, grouped by prefix length. Asking whether a port is
+reachable from an address is then a bisection plus one set lookup per prefix
+length, independent of the number of rules.
+
+Only IPv4 sources are indexed. Rules allowing traffic from members of other
+security groups don't match any address, but they do make a port reachable
+when no address is given.
+"""
+
+import bisect
+import socket
+import struct
+import time
+
+import cachedb
+import util
+
+d = util.logger.debug
+
+MAX_PORT = 65535
+
+# the cached rules are used if the cache is at most this many seconds old
+MAX_CACHE_AGE = 600
+
+# pseudo-network of rules with a security group as source
+GROUP_SOURCE = (-1, -1)
+
+
+def ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def parse_cidr(cidr):
+    """Returns (prefix length, network as int) of IPv4 CIDR."""
+    address, _, plen = cidr.partition('/')
+    plen = int(plen) if plen else 32
+    mask = (0xffffffff << (32 - plen)) & 0xffffffff
+    return plen, ip_to_int(address) & mask
+
+
+def normalize(rule):
+    """Returns (protocol, from_port, to_port, source) of ingress rule in Nova
+    or Neutron format, or None if the rule doesn't apply to IPv4 ingress.
+
+    protocol is None for any protocol, source is (prefix length, network) or
+    GROUP_SOURCE.
+    """
+    if 'direction' in rule:
+        if rule['direction'] != 'ingress' or (
+                rule.get('ethertype') or 'IPv4') != 'IPv4':
+            return None
+        protocol = rule.get('protocol')
+        ports = rule.get('port_range_min'), rule.get('port_range_max')
+        cidr = rule.get('remote_ip_prefix')
+        group = rule.get('remote_group_id')
+    else:
+        protocol = rule.get('ip_protocol')
+        ports = rule.get('from_port'), rule.get('to_port')
+        cidr = (rule.get('ip_range') or {}).get('cidr')
+        group = (rule.get('group') or {}).get('name')
+    if cidr and ':' in cidr:
+        return None
+    if cidr:
+        source = parse_cidr(cidr)
+    elif group:
+        source = GROUP_SOURCE
+    else:
+        source = parse_cidr('0.0.0.0/0')
+    protocol = str(protocol).lower() if protocol not in (None, '', -1,
+                                                         '-1') else None
+    lo, hi = ports
+    if protocol not in ('tcp', 'udp') or lo in (None, -1):
+        lo, hi = 0, MAX_PORT
+    elif hi in (None, -1):
+        hi = lo
+    return protocol, int(lo), int(hi), source
+
+
+class _PortIndex(object):
+    """Port segments of rules of one group and protocol."""
+
+    def __init__(self, rules):
+        """rules is list of (from_port, to_port, source)"""
+        self.starts = sorted(set([lo for lo, _, _ in rules] +
+                                 [hi + 1 for _, hi, _ in rules]))
+        # segment k is ports starts[k] .. starts[k+1]-1, maps prefix length
+        # to set of networks
+        self.segments = [{} for _ in self.starts]
+        for lo, hi, (plen, net) in rules:
+            first = bisect.bisect_left(self.starts, lo)
+            last = bisect.bisect_left(self.starts, hi + 1)
+            for k in xrange(first, last):
+                self.segments[k].setdefault(plen, set()).add(net)
+
+    def match(self, port, address=None):
+        k = bisect.bisect_right(self.starts, port) - 1
+        if k < 0:
+            return False
+        networks = self.segments[k]
+        if address is None:
+            return bool(networks)
+        for plen, nets in networks.iteritems():
+            if plen < 0:
+                continue
+            mask = (0xffffffff << (32 - plen)) & 0xffffffff
+            if address & mask in nets:
+                return True
+        return False
+
+
+class RuleIndex(object):
+    """Rules of security groups, queried by group ids or names."""
+
+    def __init__(self, groups):
+        """groups is iterable of (id, name, rules)."""
+        compiled = {}
+        for gid, name, rules in groups:
+            by_protocol = {}
+            for rule in rules:
+                n = normalize(rule)
+                if n is None:
+                    continue
+                protocol, lo, hi, source = n
+                by_protocol.setdefault(protocol, []).append((lo, hi, source))
+            index = dict((p, _PortIndex(r)) for p, r in by_protocol.items())
+            # groups can have the same name, their rules then add up
+            for key in (gid, name):
+                compiled.setdefault(key, []).append(index)
+        self._groups = compiled
+
+    def __contains__(self, group):
+        return group in self._groups
+
+    def reachable(self, groups, port, address=None, protocol='tcp'):
+        """Returns True if some of the groups (ids or names) allows the port
+        from the address. Without address, any source counts."""
+        if address is not None:
+            address = ip_to_int(address)
+        for group in groups:
+            for index in self._groups.get(group, []):
+                for p in (protocol, None):
+                    if p in index and index[p].match(port, address):
+                        return True
+        return False
+
+    def allowing(self, groups, port, address=None, protocol='tcp'):
+        """Returns those of the groups which allow the port."""
+        return [g for g in groups
+                if self.reachable([g], port, address, protocol)]
+
+
+def from_nova(nova=None):
+    nova = nova or util.NovaProxy()
+    return RuleIndex((g.id, g.name, g.rules)
+                     for g in nova.security_groups.list())
+
+
+def from_cache(tenant=None, max_age=MAX_CACHE_AGE):
+    """Returns RuleIndex of the cached security groups, None if the cache
+    is missing or older than max_age seconds."""
+    try:
+        cache = cachedb.Cache(tenant or util._TENANT)
+    except cachedb.CacheError as e:
+        d(str(e))
+        return None
+    try:
+        if max_age is not None and time.time() - cache.updated > max_age:
+            return None
+        return RuleIndex(cache.secgroup_rules())
+    finally:
+        cache.close()
+
+
+def load(tenant=None, max_age=MAX_CACHE_AGE, nova=None):
+    """Returns RuleIndex from the cache if it's fresh, otherwise from Nova.
+    """
+    index = from_cache(tenant, max_age)
+    if index is None:
+        d("Listing security groups for rule index")
+        index = from_nova(nova)
+    return index
@@ -0,0 +1,191 @@
+"""
+Waiting for sshd on new instances.
+
+Instead of forking "ssh ... exit" every few seconds, hosts are probed
+in-process with non-blocking sockets: a probe succeeds when port 22 accepts
+the connection and sends an SSH banner. Failed probes are retried with
+jittered exponential backoff, and any number of hosts are watched at once.
+Only when a host shows the banner, one real key-authenticated ssh login is
+tried, to be sure that cloud-init has put the key in place.
+"""
+
+import errno
+import random
+import select
+import socket
+import time
+from multiprocessing.pool import ThreadPool
+
+import util
+
+i = util.logger.info
+d = util.logger.debug
+
+SSH_PORT = 22
+
+# seconds to wait for TCP connection and for the banner after it
+CONNECT_TIMEOUT = 3
+BANNER_TIMEOUT = 5
+
+# retry interval bounds and growth, interval is randomized by +-JITTER
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 8
+BACKOFF = 1.5
+JITTER = 0.3
+
+# give up after this many seconds
+PROBE_TIMEOUT = 600
+
+# how many real ssh logins can run at once
+SSH_CHECKS = 8
+
+
+class SSHProbeError(util.NovaWrapperError):
+    pass
+
+
+def ssh_login(ssh_user, ip):
+    """Tries key-authenticated ssh login, returns True on success."""
+    ssh_cmd = ("ssh -q -o ConnectTimeout=%d -o BatchMode=yes -i %s %s@%s exit"
+               % (CONNECT_TIMEOUT, util.PRIVKEY_FILE, ssh_user, ip))
+    return util.call(ssh_cmd) == 0
+
+
+def read_banner(ip, port=SSH_PORT, timeout=CONNECT_TIMEOUT + BANNER_TIMEOUT):
+    """Returns SSH banner of host, or None if it doesn't send one."""
+    try:
+        sock = socket.create_connection((ip, port), timeout)
+        try:
+            banner = sock.recv(256)
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout):
+        return None
+    return banner if banner.startswith('SSH-') else None
+
+
+class _Probe(object):
+
+    def __init__(self, ip, ssh_user, now):
+        self.ip = ip
+        self.ssh_user = ssh_user
+        self.started = now
+        self.interval = MIN_INTERVAL
+        self.next_try = now
+        self.deadline = None
+        self.sock = None
+        self.state = 'waiting'
+        self.login = None
+        self.ready_after = None
+
+    def retry(self, now, reason):
+        d("sshd on %s not ready (%s)" % (self.ip, reason))
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.state = 'waiting'
+        self.next_try = now + self.interval * random.uniform(1 - JITTER,
+                                                             1 + JITTER)
+        self.interval = min(MAX_INTERVAL, self.interval * BACKOFF)
+
+    def connect(self, now):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((self.ip, SSH_PORT))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.retry(now, errno.errorcode.get(err, err))
+            return
+        self.state = 'connecting'
+        self.deadline = now + CONNECT_TIMEOUT
+
+    def connected(self, now):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.retry(now, errno.errorcode.get(err, err))
+            return
+        self.state = 'banner'
+        self.deadline = now + BANNER_TIMEOUT
+
+    def readable(self, now, pool):
+        try:
+            banner = self.sock.recv(256)
+        except socket.error as e:
+            self.retry(now, e)
+            return
+        if not banner.startswith('SSH-'):
+            self.retry(now, 'no SSH banner')
+            return
+        d("sshd on %s sent banner %s" % (self.ip, banner.strip()))
+        self.sock.close()
+        self.sock = None
+        if self.ssh_user is None:
+            self.ready(now)
+            return
+        self.state = 'login'
+        self.login = pool.apply_async(ssh_login, (self.ssh_user, self.ip))
+
+    def ready(self, now):
+        self.state = 'ready'
+        self.ready_after = now - self.started
+        i("sshd on %s ready after %.1fs" % (self.ip, self.ready_after))
+
+
+def wait_for_ssh(targets, timeout=PROBE_TIMEOUT):
+    """Waits until sshd on all hosts is ready.
+
+    targets is dict ip -> ssh user. If user is None, the SSH banner is
+    enough, otherwise a real ssh login is tried after the banner appears.
+    Returns dict ip -> seconds until ready. Raises SSHProbeError on timeout.
+    """
+    start = time.time()
+    probes = [_Probe(ip, user, start) for ip, user in targets.items()]
+    pool = ThreadPool(min(SSH_CHECKS, max(1, len(probes))))
+    try:
+        while True:
+            now = time.time()
+            pending = [p for p in probes if p.state != 'ready']
+            if not pending:
+                break
+            if now - start > timeout:
+                raise SSHProbeError("Timeout after %ds waiting for sshd on %s"
+                                    % (timeout, [p.ip for p in pending]))
+            for p in pending:
+                if p.state == 'waiting' and p.next_try <= now:
+                    p.connect(now)
+                elif p.state in ('connecting', 'banner') and p.deadline < now:
+                    p.retry(now, 'timeout in state %s' % p.state)
+                elif p.state == 'login' and p.login.ready():
+                    if p.login.get():
+                        p.ready(now)
+                    else:
+                        p.retry(now, 'ssh login failed')
+
+            writers = [p for p in pending if p.state == 'connecting']
+            readers = [p for p in pending if p.state == 'banner']
+            wakeups = [p.next_try for p in pending if p.state == 'waiting']
+            wakeups += [p.deadline for p in writers + readers]
+            # logins run in the pool, they're checked every 0.1s
+            wait = 0.1
+            if wakeups:
+                wait = max(0, min(wakeups) - time.time())
+                if any(p.state == 'login' for p in pending):
+                    wait = min(wait, 0.1)
+            if not writers and not readers:
+                time.sleep(wait)
+                continue
+            readable, writable, _ = select.select(
+                [p.sock for p in readers], [p.sock for p in writers], [], wait)
+            now = time.time()
+            for p in writers:
+                if p.sock in writable:
+                    p.connected(now)
+            for p in readers:
+                if p.sock in readable:
+                    p.readable(now, pool)
+    finally:
+        for p in probes:
+            if p.sock is not None:
+                p.sock.close()
+        pool.close()
+        pool.join()
+    return dict((p.ip, p.ready_after) for p in probes)
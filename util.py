@@ -1,12 +1,18 @@
+import email.utils
+import errno
 import os
+import hashlib
+import json
 import logging
+import random
 import subprocess
+import tempfile
+import threading
+import time
+import types
 import uuid
 
-import novaclient.v1_1
-import glanceclient
-import keystoneclient.v2_0
-import neutronclient.neutron.client
+import apistats
 
 # set the following variables to what you like
 
@@ -31,11 +37,44 @@ BASE_SECGROUPS = 'default'
 # path to file with private key for your openstack keypair
 PRIVKEY_FILE = os.path.expanduser("~/keys/tkarasek_key.pem")
 
-# openstack variables
-_USERNAME = os.environ['OS_USERNAME']
-_PASSWORD = os.environ['OS_PASSWORD']
-_TENANT = os.environ['OS_TENANT_NAME']
-_AUTH_URL = os.environ['OS_AUTH_URL']
+# domain of the hostnames Forge gives to floating IPs, ip-a-b-c-d.<domain>
+FORGE_DOMAIN = 'hosts.forgeservicelab.fi'
+
+# directory where Keystone tokens and service catalogs are cached between runs
+TOKEN_CACHE_DIR = os.path.expanduser("~/.cache/os_utils")
+
+# cached token is not used if it expires in less than this many seconds
+TOKEN_EXPIRY_MARGIN = 300
+
+# keep-alive connections kept per API host. All clients of all tenants in a
+# process share them (see share_http_pool).
+HTTP_POOL_SIZE = 10
+
+# API calls going through the shared HTTP pool are scheduled (see
+# _schedule): at most this many calls to one service (compute, image, ..)
+# run at once
+API_CONCURRENCY = 10
+
+# calls per second of a tenant, shared by all its threads. The rate is halved
+# whenever the cloud throttles us (413/429) and grows back by API_RATE_STEP
+# with each successful call, up to API_MAX_RATE.
+API_RATE = 10
+API_MAX_RATE = 50
+API_RATE_STEP = 0.1
+
+# how many times a throttled call, or an idempotent call failing with 5xx or
+# a connection error, is retried. Retries back off exponentially (with
+# jitter) from API_BACKOFF seconds up to API_MAX_BACKOFF, unless the API
+# says how long to wait in Retry-After.
+API_RETRIES = 5
+API_BACKOFF = 0.5
+API_MAX_BACKOFF = 30
+
+# openstack variables. Credentials are read from the environment only when
+# a session first needs them (see credentials()), and the client libraries
+# are imported only when a client is first built, so that tools working from
+# the local cache start fast and without OS_PASSWORD.
+_TENANT = os.environ.get('OS_TENANT_NAME')
 
 
 logger = logging.getLogger('os_utils')
@@ -53,53 +92,545 @@ class NovaWrapperError(Exception):
 class AnsibleWrapperError(Exception):
     pass
 
+def credentials():
+    """Returns (username, password, auth_url) from the environment."""
+    try:
+        return (os.environ['OS_USERNAME'], os.environ['OS_PASSWORD'],
+                os.environ['OS_AUTH_URL'])
+    except KeyError as e:
+        raise NovaWrapperError("Environment variable %s is not set, source "
+                               "your openrc first" % e.args[0])
+
+
+def mkdirp(path, mode=0777):
+    """Creates directory path with its parents, unless it exists (also when
+    other process or thread creates it meanwhile)."""
+    try:
+        os.makedirs(path, mode)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _token_cache_file(auth_url, username, tenant):
+    key = hashlib.sha1('\n'.join([auth_url, username, tenant])).hexdigest()
+    return os.path.join(TOKEN_CACHE_DIR, 'token_%s.json' % key)
+
+
+def load_auth_ref(auth_url, username, tenant):
+    """Returns cached Keystone auth_ref dict, or None if there's none."""
+    try:
+        with open(_token_cache_file(auth_url, username, tenant)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_auth_ref(auth_url, username, tenant, auth_ref):
+    """Caches Keystone auth_ref (token and service catalog) in a file
+    readable only by the current user."""
+    mkdirp(TOKEN_CACHE_DIR, 0700)
+    # mkstemp creates the file with 0600
+    fd, tmp_path = tempfile.mkstemp(dir=TOKEN_CACHE_DIR)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(auth_ref), f)
+    os.rename(tmp_path, _token_cache_file(auth_url, username, tenant))
+
+
+def drop_auth_ref(auth_url, username, tenant):
+    try:
+        os.unlink(_token_cache_file(auth_url, username, tenant))
+    except OSError:
+        pass
+
+
+def http_status(exc):
+    """Returns HTTP status of an API error, None if exc has none."""
+    # each of the client libraries has its own exception class and its own
+    # name for the HTTP status attribute
+    for attr in ('code', 'http_status', 'status_code'):
+        status = getattr(exc, attr, None)
+        if isinstance(status, (int, long)):
+            return status
+    return None
+
+
+def _is_unauthorized(exc):
+    return http_status(exc) == 401
+
+
+class _ClientProxy(object):
+    """Forwards attribute access to a client of a TenantSession.
+
+    Calls failing on HTTP 401 (expired or revoked token) are retried once,
+    after the session re-authenticates.
+    """
+
+    def __init__(self, session, kind, path=()):
+        self._session = session
+        self._kind = kind
+        self._path = path
+
+    def _target(self):
+        obj = self._session.client(self._kind)
+        for name in self._path:
+            obj = getattr(obj, name)
+        return obj
+
+    def _call(self, method, args, kwargs):
+        # args and kwargs are passed as they are, callers' keyword arguments
+        # (i.e. name=) can't clash with ours
+        generation = self._session.generation
+        try:
+            return getattr(self._target(), method)(*args, **kwargs)
+        except Exception as e:
+            if not _is_unauthorized(e):
+                raise
+            logger.debug("%s call %s got 401, re-authenticating"
+                         % (self._kind, '.'.join(self._path + (method,))))
+            self._session.reauthenticate(generation)
+            return getattr(self._target(), method)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        value = getattr(self._target(), name)
+        if isinstance(value, (types.MethodType, types.FunctionType)):
+            return lambda *args, **kwargs: self._call(name, args, kwargs)
+        if isinstance(value, (basestring, int, long, float, dict, list,
+                              tuple, types.NoneType)):
+            return value
+        return _ClientProxy(self._session, self._kind, self._path + (name,))
+
+
+_http_adapter = None
+_http_lock = threading.Lock()
+
+# methods which can be retried when it's not known if the call got through
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class RateLimiter(object):
+    """Token bucket of the API calls of a tenant, shared by its threads.
+
+    The rate adapts to what the cloud allows: it's halved when a call is
+    throttled and grows a little with each successful call. A throttled call
+    pauses all the threads of the tenant, not just the one which made it.
+    """
+
+    def __init__(self, rate=API_RATE):
+        self.rate = float(rate)
+        self._tokens = 1.0
+        self._stamp = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the tenant can make a call."""
+        while True:
+            with self._lock:
+                now = time.time()
+                if now < self._paused_until:
+                    self._tokens = 0.0
+                    wait = self._paused_until - now
+                else:
+                    # bursts of at most one second worth of calls
+                    self._tokens = min(self.rate, self._tokens +
+                                       (now - self._stamp) * self.rate)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._stamp = now
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                self._stamp = now
+            time.sleep(wait)
+
+    def throttled(self, pause):
+        with self._lock:
+            now = time.time()
+            # calls made at once are throttled at once, count them once
+            if now >= self._paused_until:
+                self.rate = max(self.rate / 2, 1.0)
+            self._paused_until = max(self._paused_until, now + pause)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.rate + API_RATE_STEP, API_MAX_RATE)
+
+
+_rate_limiters = {}
+# auth token or tenant name -> (auth_url, tenant), key of the rate limiter
+_limiter_keys = {}
+_service_slots = {}
+
+def _rate_limiter(headers):
+    # novaclient re-authenticating by itself gets a token we don't know, but
+    # it sends the tenant name as well, which maps to the same key. Calls
+    # without either (authentication) share one limiter.
+    project = headers.get('X-Auth-Project-Id')
+    key = (_limiter_keys.get(headers.get('X-Auth-Token')) or
+           _limiter_keys.get(project) or (project and (None, project)))
+    with _http_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter()
+        return _rate_limiters[key]
+
+
+def _service_slot(service):
+    with _http_lock:
+        if service not in _service_slots:
+            _service_slots[service] = threading.BoundedSemaphore(
+                API_CONCURRENCY)
+        return _service_slots[service]
+
+
+def _retry_after(headers):
+    """Returns seconds from the Retry-After header, None if there's none."""
+    value = (headers.get('Retry-After') or '').strip()
+    if value.isdigit():
+        return float(value)
+    date = email.utils.parsedate_tz(value) if value else None
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+def _backoff(attempt):
+    # random in the whole interval, so that threads failing together don't
+    # retry together
+    return random.uniform(0, min(API_MAX_BACKOFF, API_BACKOFF * 2 ** attempt))
+
+
+def _schedule(send, request, retry_errors):
+    """Sends requests.PreparedRequest with send(request) within the
+    concurrency cap of its service and the rate of its tenant.
+
+    Throttled calls (429, or 413 with Retry-After) are retried whatever the
+    method, the cloud didn't process them. Idempotent calls are retried also
+    on 5xx and on the exceptions in retry_errors.
+    """
+    service = apistats.url_template(request.url)[0]
+    limiter = _rate_limiter(request.headers)
+    idempotent = request.method in IDEMPOTENT_METHODS
+    for attempt in range(API_RETRIES + 1):
+        limiter.acquire()
+        with _service_slot(service):
+            try:
+                response = send(request)
+            except retry_errors as e:
+                if not idempotent or attempt == API_RETRIES:
+                    raise
+                reason, wait = str(e), _backoff(attempt)
+            else:
+                status = response.status_code
+                retry_after = _retry_after(response.headers)
+                # Nova answers 413 also when a quota is exceeded, which
+                # retrying doesn't help
+                throttled = status == 429 or (status == 413 and
+                                              retry_after is not None)
+                if not throttled and (status < 500 or not idempotent):
+                    limiter.succeeded()
+                    return response
+                if attempt == API_RETRIES:
+                    return response
+                reason = 'HTTP %d' % status
+                wait = retry_after if retry_after is not None \
+                    else _backoff(attempt)
+                if throttled:
+                    limiter.throttled(wait)
+                # read the body, so that the connection goes back to the pool
+                response.content
+                response.close()
+        logger.debug("%s %s failed with %s, retry %d in %.1fs"
+                     % (request.method, request.url, reason, attempt + 1,
+                        wait))
+        time.sleep(wait)
+
+
+def share_http_pool(size=None):
+    """Makes requests sessions created from now on share one HTTP adapter,
+    i.e. one pool of keep-alive connections per host, so that a TLS handshake
+    is done once per host instead of once per client. size is the number of
+    connections kept per host, at least HTTP_POOL_SIZE. All calls through the
+    adapter are scheduled by _schedule.
+
+    Clients which don't use requests (old neutronclient with httplib2, old
+    glanceclient with httplib) keep their own connections.
+    """
+    global _http_adapter
+    import requests
+    import requests.adapters
+
+    class SharedAdapter(requests.adapters.HTTPAdapter):
+        def send(self, request, **kwargs):
+            parent = super(SharedAdapter, self).send
+            return _schedule(lambda r: parent(r, **kwargs), request,
+                             (requests.ConnectionError, requests.Timeout))
+
+        def close(self):
+            # sessions closing don't close the connections of the others
+            pass
+
+    size = max(size or 0, HTTP_POOL_SIZE)
+    with _http_lock:
+        if _http_adapter is not None and _http_adapter.size >= size:
+            return
+        first = _http_adapter is None
+        # pool_connections is how many hosts have a pool
+        _http_adapter = SharedAdapter(pool_connections=32, pool_maxsize=size)
+        _http_adapter.size = size
+        if not first:
+            return
+        original_init = requests.Session.__init__
+
+        def init(session, *args, **kwargs):
+            original_init(session, *args, **kwargs)
+            session.mount('https://', _http_adapter)
+            session.mount('http://', _http_adapter)
+
+        requests.Session.__init__ = init
+
+
+class TenantSession(object):
+    """Clients of one tenant, sharing a single Keystone authentication.
+
+    Nova, Glance and Neutron clients are built from the token and service
+    catalog of the tenant's Keystone client, so a session authenticates only
+    once however many clients are used. The token and catalog are cached on
+    disk (see TOKEN_CACHE_DIR), so that next runs don't authenticate at all
+    until the token is about to expire. Sessions are thread-safe.
+
+    auth_url, username and password not given are taken from the
+    environment (see credentials()). With region, endpoints of that region
+    are used, otherwise the first ones in the catalog.
+    """
+
+    def __init__(self, tenant=None, auth_url=None, region=None,
+                 username=None, password=None):
+        self.tenant = tenant or _TENANT
+        self.region = region
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._credentials = None
+        if username and password and auth_url:
+            self._credentials = (username, password, auth_url)
+        self._overrides = (username, password, auth_url)
+
+    def credentials(self):
+        if self.tenant is None:
+            raise NovaWrapperError("Environment variable OS_TENANT_NAME is "
+                                   "not set, source your openrc first")
+        if self._credentials is None:
+            self._credentials = tuple(
+                given or default for given, default in
+                zip(self._overrides, credentials()))
+        return self._credentials
+
+    def client(self, kind):
+        """Returns the plain client of kind "keystone", "nova", .."""
+        with self._lock:
+            if kind not in self._clients:
+                share_http_pool()
+                self._clients[kind] = getattr(self, '_new_' + kind)()
+                if kind == 'keystone':
+                    # for the rate limiter of the tenant
+                    key = (self.credentials()[2], self.tenant)
+                    _limiter_keys[self._clients[kind].auth_token] = key
+                    _limiter_keys.setdefault(self.tenant, key)
+            return self._clients[kind]
+
+    def reauthenticate(self, generation=None):
+        """Drops cached token and clients. If generation is given and other
+        thread already re-authenticated since, does nothing."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            username, _, auth_url = self.credentials()
+            drop_auth_ref(auth_url, username, self.tenant)
+            self._clients = {}
+            self.generation += 1
+
+    def endpoint(self, service_type):
+        catalog = self.client('keystone').service_catalog
+        kwargs = {}
+        if self.region:
+            kwargs = dict(attr='region', filter_value=self.region)
+        url = catalog.url_for(service_type=service_type,
+                              endpoint_type='publicURL', **kwargs)
+        apistats.register_endpoint(url, service_type)
+        return url
+
+    def _new_keystone(self):
+        import keystoneclient.v2_0.client
+        username, password, auth_url = self.credentials()
+        apistats.register_endpoint(auth_url, 'identity')
+        kwargs = dict(username=username, password=password,
+                      tenant_name=self.tenant, auth_url=auth_url)
+        auth_ref = load_auth_ref(auth_url, username, self.tenant)
+        if auth_ref is not None:
+            client = keystoneclient.v2_0.client.Client(auth_ref=auth_ref,
+                                                       **kwargs)
+            if not client.auth_ref.will_expire_soon(TOKEN_EXPIRY_MARGIN):
+                return client
+        client = keystoneclient.v2_0.client.Client(**kwargs)
+        save_auth_ref(auth_url, username, self.tenant, client.auth_ref)
+        return client
+
+    def _new_nova(self):
+        import novaclient.v1_1.client
+        username, password, auth_url = self.credentials()
+        # the password is passed as well so that novaclient can
+        # re-authenticate by itself when the token expires
+        return novaclient.v1_1.client.Client(
+            username=username, api_key=password,
+            auth_url=auth_url, project_id=self.tenant,
+            auth_token=self.client('keystone').auth_token,
+            region_name=self.region, bypass_url=self.endpoint('compute'))
+
+    def _new_glance(self):
+        import glanceclient
+        return glanceclient.Client('1', self.endpoint('image'),
+            token=self.client('keystone').auth_token)
+
+    def _new_neutron(self):
+        import neutronclient.neutron.client
+        return neutronclient.neutron.client.Client('2.0',
+            endpoint_url=self.endpoint('network'),
+            token=self.client('keystone').auth_token)
+
+    def keystone(self):
+        return _ClientProxy(self, 'keystone')
+
+    def nova(self):
+        return _ClientProxy(self, 'nova')
+
+    def glance(self):
+        return _ClientProxy(self, 'glance')
+
+    def neutron(self):
+        return _ClientProxy(self, 'neutron')
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def default_session():
+    """Session for the tenant in _TENANT, shared unless reuse_proxies is off.
+    """
+    global _session
+    if not reuse_proxies:
+        return TenantSession(_TENANT)
+    with _session_lock:
+        if _session is None or _session.tenant != _TENANT:
+            _session = TenantSession(_TENANT)
+        return _session
+
+
 class KeystoneProxy(object):
-    _client = None
     def __new__(cls, *args, **kwargs):
-        if not cls._client or not reuse_proxies:
-            cls._client = keystoneclient.v2_0.client.Client(
-            username=_USERNAME, password=_PASSWORD,
-            tenant_name=_TENANT, auth_url=_AUTH_URL
-        )
-        return cls._client
+        return default_session().keystone()
 
 
 class NovaProxy(object):
-    _client = None
     def __new__(cls, *args, **kwargs):
-        if not cls._client or not reuse_proxies:
-            # nova client cant be create from Keystone catalog URL ...
-            cls._client = novaclient.v1_1.client.Client(
-                username=_USERNAME, api_key=_PASSWORD,
-                auth_url=_AUTH_URL, project_id=_TENANT)
-        return cls._client
+        return default_session().nova()
 
 
 class GlanceProxy(object):
-    _client = None
     def __new__(cls, *args, **kwargs):
-        if not cls._client or not reuse_proxies:
-            # Glance client can be created from Keystone catalog URL
-            endpoints  = KeystoneProxy().service_catalog.get_endpoints()
-            url = endpoints["image"][0]["publicURL"]
-            cls._client = glanceclient.Client('1', url,
-                token=KeystoneProxy().auth_token)
-        return cls._client
+        return default_session().glance()
 
 
 class NeutronProxy(object):
-    _client = None
     def __new__(cls, *args, **kwargs):
-        if not cls._client or not reuse_proxies:
-            endpoints  = KeystoneProxy().service_catalog.get_endpoints()
-            url = endpoints["network"][0]["publicURL"]
-            cls._client = neutronclient.neutron.client.Client(
-                '2.0', endpoint_url=url, token=KeystoneProxy().auth_token)
-        return cls._client
+        return default_session().neutron()
 
 
-def callCheck(command, env=None, stdin=None):
+def find_resource_id_by_name(name, resource_list, use_getitem=False,
+                             subitem=None):
+    try:
+        uuid.UUID(name)
+        # name is uuid
+        return name
+    except ValueError:
+        if subitem:
+            resource_list = resource_list[subitem]
+        if use_getitem:
+            matching = [r['id'] for r in resource_list if name == r['name']]
+        else:
+            matching = [r.id for r in resource_list if name == r.name]
+        if len(matching) == 0:
+            msg = ("Could not find any resource matching name '%s'. "
+                   "If this is an image, check that it's public or shared "
+                   "with the current tenant (it's listed in $ glance index)"
+                   % name)
+            raise NovaWrapperError(msg)
+        if len(matching) > 1:
+            raise NovaWrapperError(
+                "Found too many resources matching name '%s': %s" %
+                (name, matching))
+        return matching[0]
+
+
+def add_profile_args(parser):
+    """Adds the --profile options common to all tools to argparse parser.
+    """
+    parser.add_argument('--profile', action='store_true',
+                        help='print API calls and phases with timings at exit')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='append API calls and phases to FILE as JSON '
+                             'lines')
+
+
+def setup_profile(args):
+    """Starts recording API calls if asked for by the --profile options."""
+    if args.profile or args.profile_json:
+        apistats.enable(report=args.profile, json_file=args.profile_json)
+
+
+# marks a phase of a tool for --profile, i.e. "with util.phase('boot'):"
+phase = apistats.phase
+
+
+def name_regex(substring):
+    """Escapes substring for the name filter of servers.list, which Nova
+    matches as a regular expression."""
+    return ''.join('\\' + c if c in '.^$*+?{}[]\\|()' else c
+                   for c in substring)
+
+
+def forge_hostname(ip):
+    """Returns Forge hostname of floating IP."""
+    return 'ip-%s.%s' % (ip.replace('.', '-'), FORGE_DOMAIN)
+
+
+def forge_hostname_ip(hostname):
+    """Returns IP of Forge hostname, None if it isn't one."""
+    hostname = hostname.lower()
+    suffix = '.' + FORGE_DOMAIN
+    if hostname.startswith('ip-') and hostname.endswith(suffix):
+        return hostname[len('ip-'):-len(suffix)].replace('-', '.')
+    return None
+
+
+def is_address(name):
+    """Returns True if name is an IPv4 address or a Forge hostname."""
+    parts = (forge_hostname_ip(name) or name).split('.')
+    return len(parts) == 4 and all(p.isdigit() and int(p) < 256
+                                   for p in parts)
+
+
+def iso_time(timestamp):
+    """Formats seconds since epoch the way OpenStack APIs want it."""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def call(command, env=None, stdin=None):
+    """Runs command, returns its exit status."""
     logger.info("about to run \"%s\"" % command)
-    if subprocess.call(command.split(), env=env, stdin=stdin):
+    return subprocess.call(command.split(), env=env, stdin=stdin)
+
+
+def callCheck(command, env=None, stdin=None):
+    if call(command, env=env, stdin=stdin):
         raise Exception("%s failed." % command)
 
@@ -0,0 +1,188 @@
+"""
+Waiting for Nova servers to get to some state.
+
+A single server is polled with servers.get. Several servers are polled
+together with one servers.list per round, asking only for servers changed
+since the previous round (changes-since), with a full listing every few
+rounds in case some change didn't bump the server's update time.
+
+Polling starts every MIN_INTERVAL and backs off from there, but a poll is
+never pushed past EXPECTED_BUILD_TIME, when the servers are most likely to
+get ready. For each server it's recorded how long it spent in each status.
+"""
+
+import time
+
+import util
+
+i = util.logger.info
+d = util.logger.debug
+
+# typical time for a server to go from BUILD to ACTIVE, in seconds
+EXPECTED_BUILD_TIME = 15
+
+# bounds of interval between two polls, in seconds
+MIN_INTERVAL = 1
+MAX_INTERVAL = 10
+
+# interval is multiplied by this each round
+BACKOFF = 1.5
+
+# in batched polls, do full listing instead of changes-since every N rounds
+FULL_POLL_EVERY = 5
+
+# give up waiting after this many seconds
+WAIT_TIMEOUT = 600
+
+# changes-since asks from this many seconds before previous poll, to allow
+# for clock skew between us and Nova
+CHANGES_SINCE_OVERLAP = 60
+
+
+class ServerWaitError(util.NovaWrapperError):
+    """Timeout of waiting. waits is dict server_id -> ServerWait of all the
+    servers, the ones not done are still pending."""
+
+    def __init__(self, message, waits=None):
+        util.NovaWrapperError.__init__(self, message)
+        self.waits = waits or {}
+
+
+def has_fixed_ip(server):
+    if server is None or not server.networks:
+        return False
+    return any(len(net) > 0 for net in server.networks.values())
+
+
+def is_active(server):
+    return server is not None and server.status == 'ACTIVE'
+
+
+def is_gone(server):
+    return server is None
+
+
+class ServerWait(object):
+    """Progress of waiting for one server.
+
+    server is the last seen state of the server (None if it's gone),
+    durations is list of (status, seconds) in order of the statuses.
+    """
+
+    def __init__(self, server_id, start):
+        self.server_id = server_id
+        self.server = None
+        self.status = None
+        self.done = False
+        self.failed = False
+        self.durations = []
+        self._since = start
+
+    def update(self, server, now):
+        self.server = server
+        status = server.status if server is not None else 'DELETED'
+        if status != self.status:
+            if self.status is not None:
+                self.durations.append((self.status, now - self._since))
+            self.status = status
+            self._since = now
+
+    def finish(self, now, failed=False):
+        self.done = True
+        self.failed = failed
+        self.durations.append((self.status, now - self._since))
+
+    def __str__(self):
+        return "%s: %s" % (self.server_id, ', '.join(
+            '%s %.1fs' % (status, secs) for status, secs in self.durations))
+
+
+def next_interval(elapsed, interval):
+    """Returns how long to sleep before next poll, interval is the previous
+    sleep (None before the first one)."""
+    if interval is None:
+        return MIN_INTERVAL
+    interval = interval * BACKOFF
+    if elapsed < EXPECTED_BUILD_TIME:
+        interval = min(interval, EXPECTED_BUILD_TIME - elapsed)
+    return min(MAX_INTERVAL, max(MIN_INTERVAL, interval))
+
+
+def _get_server(nova, server_id):
+    try:
+        return nova.servers.get(server_id)
+    except Exception as e:
+        if getattr(e, 'code', None) == 404:
+            return None
+        raise
+
+
+def _poll(nova, waits, search_opts, since):
+    """Returns dict server_id -> server (None for deleted servers) of the
+    servers which might have changed."""
+    if len(waits) == 1:
+        server_id = waits[0].server_id
+        return {server_id: _get_server(nova, server_id)}
+    opts = dict(search_opts or {})
+    if since is not None:
+        opts['changes-since'] = util.iso_time(since)
+    listed = dict((s.id, s) for s in nova.servers.list(search_opts=opts))
+    polled = {}
+    for w in waits:
+        if w.server_id in listed:
+            s = listed[w.server_id]
+            polled[w.server_id] = None if s.status == 'DELETED' else s
+        elif since is None:
+            # not in full listing, so it's gone
+            polled[w.server_id] = None
+    return polled
+
+
+def wait_for_servers(server_ids, condition, timeout=WAIT_TIMEOUT,
+                     search_opts=None, nova=None, stop_on_error=True):
+    """Waits until condition(server) is true for all given servers.
+
+    condition gets None for a server which doesn't exist (anymore). Servers
+    in ERROR are not waited for anymore and have failed=True in the result,
+    unless stop_on_error is False (i.e. when waiting for deletion).
+    search_opts can narrow the batched servers.list (i.e. {'name': prefix}).
+
+    Returns dict server_id -> ServerWait. Raises ServerWaitError on timeout,
+    with the progress so far.
+    """
+    nova = nova or util.NovaProxy()
+    start = time.time()
+    waits = dict((sid, ServerWait(sid, start)) for sid in server_ids)
+    interval = None
+    last_poll = None
+    rounds = 0
+    while True:
+        pending = [w for w in waits.values() if not w.done]
+        if not pending:
+            break
+        now = time.time()
+        if now - start > timeout:
+            raise ServerWaitError("Timeout after %ds waiting for servers %s"
+                                  % (timeout, [w.server_id for w in pending]),
+                                  waits)
+        full = last_poll is None or rounds % FULL_POLL_EVERY == 0
+        since = None if full else last_poll - CHANGES_SINCE_OVERLAP
+        polled = _poll(nova, pending, search_opts, since)
+        last_poll = now
+        rounds += 1
+        now = time.time()
+        for w in pending:
+            if w.server_id not in polled:
+                continue
+            w.update(polled[w.server_id], now)
+            if condition(w.server):
+                w.finish(now)
+                d("Server %s ready" % w)
+            elif w.status == 'ERROR' and stop_on_error:
+                w.finish(now, failed=True)
+                util.logger.error("Server %s got to ERROR status" % w)
+        if all(w.done for w in pending):
+            continue
+        interval = next_interval(now - start, interval)
+        time.sleep(interval)
+    return waits